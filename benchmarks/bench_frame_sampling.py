@@ -0,0 +1,70 @@
+"""
+Compare the legacy read-every-frame loops against grab/seek sampling.
+
+Run from the repo root:
+    python -m benchmarks.bench_frame_sampling path/to/video.mp4 [--strides 8 11 15 20 30]
+"""
+import argparse
+import time
+
+import cv2
+
+from frame_source import iter_sampled_frames
+
+
+def legacy_read_all(video_path, stride):
+    """
+    The pre-sampling detector loop: read() everything, keep frame_id % stride == 0.
+    """
+    cap = cv2.VideoCapture(video_path)
+    frame_id = 0
+    kept = 0
+
+    while True:
+        ret, frame = cap.read()
+        if not ret:
+            break
+
+        if frame_id % stride == 0:
+            kept += 1
+
+        frame_id += 1
+
+    cap.release()
+    return kept
+
+
+def sampled(video_path, stride, method):
+    kept = 0
+    for _ in iter_sampled_frames(video_path, stride=stride, method=method):
+        kept += 1
+    return kept
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    kept = fn(*args)
+    return kept, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("video")
+    parser.add_argument("--strides", type=int, nargs="+", default=[8, 11, 15, 20, 30])
+    args = parser.parse_args()
+
+    print(f"[BENCH] {args.video}")
+    print(f"{'stride':>6} {'method':>8} {'frames':>7} {'seconds':>9} {'speedup':>8}")
+
+    for stride in args.strides:
+        base_kept, base_time = timed(legacy_read_all, args.video, stride)
+        print(f"{stride:>6} {'legacy':>8} {base_kept:>7} {base_time:>9.3f} {1.0:>7.2f}x")
+
+        for method in ("grab", "seek"):
+            kept, elapsed = timed(sampled, args.video, stride, method)
+            speedup = base_time / elapsed if elapsed > 0 else float("inf")
+            print(f"{stride:>6} {method:>8} {kept:>7} {elapsed:>9.3f} {speedup:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
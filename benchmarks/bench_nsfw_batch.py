@@ -0,0 +1,72 @@
+"""
+Compare the per-frame NudeNet loop against batched session runs.
+
+Run from the repo root:
+    python -m benchmarks.bench_nsfw_batch path/to/video.mp4 [--batch-sizes 1 4 8 16] [--stride 11]
+"""
+import argparse
+import time
+
+from frame_source import iter_sampled_frames
+from nsfw.nsfw_detector import (
+    NsfwVideoConsumer,
+    class_scores,
+    detector,
+    score_frames
+)
+
+
+def per_frame_loop(frames):
+    """
+    The pre-batching video loop: one detector.detect call per frame.
+    """
+    return [class_scores(detector.detect(frame)) for frame in frames]
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    scores = fn(*args)
+    return scores, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("video")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4, 8, 16])
+    parser.add_argument("--stride", type=int, default=11)
+    args = parser.parse_args()
+
+    # decode once up front: only NudeNet time is measured
+    frames = [
+        frame
+        for _, frame in iter_sampled_frames(
+            args.video,
+            stride=args.stride,
+            decode_long_side=NsfwVideoConsumer.decode_long_side
+        )
+    ]
+
+    print(f"[BENCH] {args.video}: {len(frames)} frames (stride {args.stride})")
+    if not frames:
+        return
+
+    print(f"{'method':>10} {'seconds':>9} {'frames/s':>9} {'speedup':>8} {'same':>5}")
+
+    base_scores, base_time = timed(per_frame_loop, frames)
+    print(f"{'per-frame':>10} {base_time:>9.3f} {len(frames) / base_time:>9.1f} {1.0:>7.2f}x {'-':>5}")
+
+    for batch_size in args.batch_sizes:
+        scores, elapsed = timed(score_frames, frames, batch_size)
+        speedup = base_time / elapsed if elapsed > 0 else float("inf")
+        same = all(
+            a.keys() == b.keys() and all(abs(a[k] - b[k]) < 1e-4 for k in a)
+            for a, b in zip(base_scores, scores)
+        )
+        print(
+            f"{'batch ' + str(batch_size):>10} {elapsed:>9.3f} "
+            f"{len(frames) / elapsed:>9.1f} {speedup:>7.2f}x {str(same):>5}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -30,6 +30,30 @@ INPUT_QUEUE = os.getenv(
     "fliqz_moderation_image_video_queue"
 )
 
+# =========================
+# Worker Pool (worker_pool.py)
+# =========================
+# Consumer processes forked after the models are loaded (0 = one per
+# 4 CPUs), messages each one claims ahead, and PyTorch / OpenCV /
+# TensorFlow / ONNX Runtime threads per process (0 = CPUs / processes;
+# overrides OWL_TORCH_THREADS and OWL_ONNX_THREADS in the pool). A
+# message that was in flight in more than WORKER_MAX_ATTEMPTS crashed
+# workers goes to INPUT_QUEUE:dead.
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", 0))
+WORKER_PREFETCH = int(os.getenv("WORKER_PREFETCH", 2))
+WORKER_THREADS = int(os.getenv("WORKER_THREADS", 0))
+WORKER_MAX_ATTEMPTS = int(os.getenv("WORKER_MAX_ATTEMPTS", 3))
+WORKER_RESTART_DELAY = float(os.getenv("WORKER_RESTART_DELAY", 2.0))
+# Namespace of this pool's processing lists (required by worker_pool.py).
+# Pools sharing a Redis must differ, and each must keep its id across
+# restarts (not a container host name) so it re-queues its own claims.
+WORKER_POOL_ID = os.getenv("WORKER_POOL_ID", "")
+# 1 = load the fork-safe models (OWL-V2, NudeNet, spaCy, OpenCV dnn) once
+# in the supervisor and share them with the consumers copy-on-write; the
+# TensorFlow violence model always loads in each consumer after the fork.
+# 0 = each consumer loads every model itself.
+WORKER_PRELOAD = os.getenv("WORKER_PRELOAD", "1") == "1"
+
 # =========================
 # Local LLaMA / Ollama
 # =========================
@@ -37,3 +61,205 @@ LLAMA_API_URL = os.getenv(
     "LLAMA_API_URL",
     "http://localhost:11434/api/generate"
 )
+
+# =========================
+# OWL-V2 Inference
+# =========================
+# Encode the label prompts once at startup and reuse the query
+# embeddings for every frame (only the vision tower runs per frame)
+OWL_CACHE_TEXT_QUERIES = os.getenv("OWL_CACHE_TEXT_QUERIES", "1") == "1"
+
+# Frames per OWL-V2 forward pass (video frames / keyframes)
+OWL_BATCH_SIZE = int(os.getenv("OWL_BATCH_SIZE", 4))
+
+# Pad/resize/normalise frames with OpenCV/numpy instead of the HF
+# processor (checked against it at startup on smooth and textured images,
+# falls back when the mean or any single-pixel difference is too large)
+OWL_FAST_PREPROCESS = os.getenv("OWL_FAST_PREPROCESS", "1") == "1"
+OWL_PREPROCESS_TOLERANCE = float(os.getenv("OWL_PREPROCESS_TOLERANCE", 0.01))
+OWL_PREPROCESS_MAX_TOLERANCE = float(os.getenv("OWL_PREPROCESS_MAX_TOLERANCE", 0.1))
+
+# Inference backend: "torch" (default), "torch-opt" (tuned PyTorch CPU
+# mode, see below), "onnx" (ONNX Runtime fp32) or "onnx-int8" (dynamic
+# int8 quantized). ONNX models are exported once into OWL_ONNX_DIR.
+# Non-default backends must match plain PyTorch on the parity images
+# (OWL_PARITY_IMAGE_DIR, else synthetic) within OWL_BACKEND_TOLERANCE,
+# otherwise plain PyTorch is used
+OWL_BACKEND = os.getenv("OWL_BACKEND", "torch").lower()
+OWL_ONNX_DIR = os.getenv("OWL_ONNX_DIR", "models/owlv2_onnx")
+OWL_ONNX_THREADS = int(os.getenv("OWL_ONNX_THREADS", 0))  # 0 = ORT default
+OWL_PARITY_IMAGE_DIR = os.getenv("OWL_PARITY_IMAGE_DIR", "")
+OWL_BACKEND_TOLERANCE = float(os.getenv("OWL_BACKEND_TOLERANCE", 0.05))
+
+# "torch-opt" toggles: bf16 autocast ("auto" = only on CPUs with native
+# bf16), torch.compile at the fixed 960x960 input shape, channels_last
+# layout, and warmup passes at startup (per compiled batch shape)
+OWL_TORCH_BF16 = os.getenv("OWL_TORCH_BF16", "auto").lower()
+OWL_TORCH_COMPILE = os.getenv("OWL_TORCH_COMPILE", "1") == "1"
+OWL_TORCH_CHANNELS_LAST = os.getenv("OWL_TORCH_CHANNELS_LAST", "1") == "1"
+OWL_TORCH_WARMUP = int(os.getenv("OWL_TORCH_WARMUP", 2))
+
+# PyTorch CPU threads, any backend (0 = PyTorch default)
+OWL_TORCH_THREADS = int(os.getenv("OWL_TORCH_THREADS", 0))
+OWL_TORCH_INTEROP_THREADS = int(os.getenv("OWL_TORCH_INTEROP_THREADS", 0))
+
+# =========================
+# Minor Detection
+# =========================
+# Face crops per ageNet forward call
+MINOR_AGE_BATCH_SIZE = int(os.getenv("MINOR_AGE_BATCH_SIZE", 32))
+
+# Video: follow faces across sampled frames (IoU / centroid matching) and
+# run ageNet once per face track, again every MINOR_TRACK_RECHECK_EVERY
+# sampled frames it stays visible (0 = never). A track is dropped after
+# MINOR_TRACK_MAX_MISSES sampled frames without a match.
+MINOR_TRACK_FACES = os.getenv("MINOR_TRACK_FACES", "1") == "1"
+MINOR_TRACK_IOU = float(os.getenv("MINOR_TRACK_IOU", 0.3))
+MINOR_TRACK_RECHECK_EVERY = int(os.getenv("MINOR_TRACK_RECHECK_EVERY", 20))
+MINOR_TRACK_MAX_MISSES = int(os.getenv("MINOR_TRACK_MAX_MISSES", 2))
+
+# =========================
+# Violence Detection
+# =========================
+# Sampled frames per backbone call / windows per temporal-head call
+VIOLENCE_ENCODE_BATCH_SIZE = int(os.getenv("VIOLENCE_ENCODE_BATCH_SIZE", 32))
+VIOLENCE_HEAD_BATCH_SIZE = int(os.getenv("VIOLENCE_HEAD_BATCH_SIZE", 64))
+
+# Serving: "function" (tf.function traced once, default), "keras" (plain
+# model call), "tflite-fp16" or "tflite-int8" (exported next to the .keras
+# model unless VIOLENCE_TFLITE_DIR is set). Checked against the .keras
+# model at startup; falls back to "keras" beyond VIOLENCE_BACKEND_TOLERANCE
+VIOLENCE_BACKEND = os.getenv("VIOLENCE_BACKEND", "function").lower()
+VIOLENCE_TFLITE_DIR = os.getenv("VIOLENCE_TFLITE_DIR", "")
+VIOLENCE_TFLITE_THREADS = int(os.getenv("VIOLENCE_TFLITE_THREADS", 0))  # 0 = default
+VIOLENCE_BACKEND_TOLERANCE = float(os.getenv("VIOLENCE_BACKEND_TOLERANCE", 0.02))
+
+# =========================
+# NSFW Detection
+# =========================
+# Sampled video frames per NudeNet session run
+NSFW_BATCH_SIZE = int(os.getenv("NSFW_BATCH_SIZE", 8))
+
+# Two-tier cascade: a fast tier clears / flags frames whose best
+# HARD_NSFW score is outside [NSFW_UNCERTAIN_LOW, NSFW_UNCERTAIN_HIGH);
+# frames inside the band are re-scored by the full tier.
+# - NSFW_FAST_RESOLUTION: run the default NudeNet model at this lower
+#   inference resolution as the fast tier (0 = fast tier is the 320px
+#   default)
+# - NSFW_FULL_MODEL_PATH: full tier model (e.g. NudeNet's 640m.onnx at
+#   NSFW_FULL_RESOLUTION); unset = the 320px default model
+# Neither set = single tier.
+NSFW_FAST_RESOLUTION = int(os.getenv("NSFW_FAST_RESOLUTION", 0))
+NSFW_FULL_MODEL_PATH = os.getenv("NSFW_FULL_MODEL_PATH", "")
+NSFW_FULL_RESOLUTION = int(os.getenv("NSFW_FULL_RESOLUTION", 640))
+NSFW_UNCERTAIN_LOW = float(os.getenv("NSFW_UNCERTAIN_LOW", 0.3))
+NSFW_UNCERTAIN_HIGH = float(os.getenv("NSFW_UNCERTAIN_HIGH", 0.7))
+
+# Skin gate: skip NudeNet for images / frames where less than
+# NSFW_SKIN_GATE_MIN_RATIO of the pixels (outside known face boxes) are
+# skin-coloured. Near-grayscale inputs (mean saturation below
+# NSFW_SKIN_GATE_MIN_SATURATION) always go to NudeNet. Faces are only
+# looked up for frames that would pass without them; video frames reuse
+# the boxes of the nearest frame the minor detector sampled (within half
+# its stride) and run face detection otherwise (hit / miss counts are
+# logged per video).
+NSFW_SKIN_GATE = os.getenv("NSFW_SKIN_GATE", "0") == "1"
+NSFW_SKIN_GATE_MIN_RATIO = float(os.getenv("NSFW_SKIN_GATE_MIN_RATIO", 0.02))
+NSFW_SKIN_GATE_MIN_SATURATION = float(os.getenv("NSFW_SKIN_GATE_MIN_SATURATION", 20))
+
+# =========================
+# PII OCR
+# =========================
+# "auto" = in-process tesserocr engines (one per thread) when installed
+# (requirements-ocr.txt), else pytesseract (one tesseract subprocess per call)
+OCR_BACKEND = os.getenv("OCR_BACKEND", "auto").lower()
+OCR_LANG = os.getenv("OCR_LANG", "eng")
+OCR_TESSDATA_PATH = os.getenv("OCR_TESSDATA_PATH", "")  # "" = tesseract default
+# Tesseract page segmentation mode (3 = fully automatic, its default)
+OCR_PSM = int(os.getenv("OCR_PSM", 3))
+# Before OCR: "none", "gray", "otsu" (global binarisation) or "adaptive"
+OCR_PREPROCESS = os.getenv("OCR_PREPROCESS", "none").lower()
+
+# Text-region gate: skip OCR on frames without text-like regions and OCR
+# only the detected regions (full frame when there are more than
+# PII_TEXT_MAX_REGIONS or they cover most of it). Region texts are cached
+# by exact pixels (PII_OCR_CACHE_SIZE entries) for repeated / static frames.
+# Off by default: check its recall against full-frame OCR on your own
+# (low-contrast) uploads before enabling it.
+PII_TEXT_GATE = os.getenv("PII_TEXT_GATE", "0") == "1"
+PII_TEXT_MAX_REGIONS = int(os.getenv("PII_TEXT_MAX_REGIONS", 24))
+PII_OCR_CACHE_SIZE = int(os.getenv("PII_OCR_CACHE_SIZE", 256))
+
+# Video OCR texts the cheap rules did not flag, per spaCy nlp.pipe batch
+PII_NER_BATCH_SIZE = int(os.getenv("PII_NER_BATCH_SIZE", 16))
+
+# QR / barcode scan: locate finder patterns (and 1D barcode gradient bands)
+# on a pyramid (downscaled levels, then native resolution) and run zbar on
+# those crops first; whole frame when localisation is off, finds more than
+# CODE_SCAN_MAX_CANDIDATES candidates, or its crops decode nothing
+CODE_SCAN_LOCALIZE = os.getenv("CODE_SCAN_LOCALIZE", "1") == "1"
+CODE_SCAN_BARCODES = os.getenv("CODE_SCAN_BARCODES", "1") == "1"
+CODE_SCAN_MAX_CANDIDATES = int(os.getenv("CODE_SCAN_MAX_CANDIDATES", 8))
+
+# =========================
+# Video Frame Sampling
+# =========================
+# "grab" (skip frames without retrieving them), "seek" (jump to far
+# targets by frame position) or "read" (decode every frame, legacy)
+FRAME_SAMPLING = os.getenv("FRAME_SAMPLING", "grab")
+FRAME_SEEK_MIN_GAP = int(os.getenv("FRAME_SEEK_MIN_GAP", 90))
+
+
+def _optional_float(name):
+    value = os.getenv(name)
+    return float(value) if value else None
+
+
+# Time-based sampling (one frame per N seconds, fps-aware).
+# Unset → the detectors' fixed frame strides.
+MINOR_SAMPLE_SECONDS = _optional_float("MINOR_SAMPLE_SECONDS")
+PII_SAMPLE_SECONDS = _optional_float("PII_SAMPLE_SECONDS")
+NSFW_SAMPLE_SECONDS = _optional_float("NSFW_SAMPLE_SECONDS")
+OWL_SAMPLE_SECONDS = _optional_float("OWL_SAMPLE_SECONDS")
+
+# Scene-change keyframes (video_worker) compare consecutive frames by
+# default (0). N > 0 compares one frame per N seconds and grab()s the
+# frames in between, but motion then adds up between compared frames:
+# raise the scene threshold with it.
+KEYFRAME_SAMPLE_SECONDS = float(os.getenv("KEYFRAME_SAMPLE_SECONDS", 0))
+
+# Decode backend: "opencv" (cv2.VideoCapture) or "ffmpeg" (local ffmpeg
+# subprocess piping frames already sampled and downscaled to what the
+# detectors need; software decode, no GPU required)
+FRAME_DECODE_BACKEND = os.getenv("FRAME_DECODE_BACKEND", "opencv")
+FFMPEG_BINARY = os.getenv("FFMPEG_BINARY", "ffmpeg")
+FFPROBE_BINARY = os.getenv("FFPROBE_BINARY", "ffprobe")
+FFMPEG_THREADS = int(os.getenv("FFMPEG_THREADS", 0))  # 0 = ffmpeg default
+
+
+def _optional_int(name):
+    value = os.getenv(name)
+    return int(value) if value else None
+
+
+# Longest frame side decoded for the ffmpeg backend (unset = no cap);
+# minor / PII decode at full resolution unless given a limit here
+VIDEO_DECODE_MAX_LONG_SIDE = _optional_int("VIDEO_DECODE_MAX_LONG_SIDE")
+MINOR_DECODE_LONG_SIDE = _optional_int("MINOR_DECODE_LONG_SIDE")
+PII_DECODE_LONG_SIDE = _optional_int("PII_DECODE_LONG_SIDE")
+
+# =========================
+# Video Frame Budget (OWL-V2 frames held in memory)
+# =========================
+# At most K frames spread evenly over the video, per container type
+# (e.g. VIDEO_MAX_FRAMES_BY_EXT=".mkv:48,.avi:16"), within a memory ceiling
+VIDEO_MAX_FRAMES = int(os.getenv("VIDEO_MAX_FRAMES", 32))
+VIDEO_MAX_FRAMES_BY_EXT = {
+    ext.strip().lower(): int(limit)
+    for ext, _, limit in (
+        item.partition(":")
+        for item in os.getenv("VIDEO_MAX_FRAMES_BY_EXT", "").split(",")
+        if item.strip()
+    )
+}
+VIDEO_FRAME_MEMORY_MB = float(os.getenv("VIDEO_FRAME_MEMORY_MB", 512))
@@ -1,6 +1,15 @@
 import cv2
 import os
-import tempfile
+
+from config import (
+    MINOR_AGE_BATCH_SIZE,
+    MINOR_DECODE_LONG_SIDE,
+    MINOR_TRACK_FACES,
+    MINOR_TRACK_IOU,
+    MINOR_TRACK_RECHECK_EVERY,
+    MINOR_TRACK_MAX_MISSES
+)
+from frame_source import FrameConsumer, decode_shared
 
 # -----------------------------
 # Face detection
@@ -49,84 +58,221 @@ faceNet = cv2.dnn.readNet(faceModel, faceProto)
 ageNet  = cv2.dnn.readNet(ageModel, ageProto)
 
 
+MINOR_AGE_BUCKETS = {'(0-2)', '(4-6)', '(8-12)'}
+
+
 # -----------------------------
-# Normalize image
+# Face crops
 # -----------------------------
-def normalize_to_jpg(image):
-    temp_file = tempfile.NamedTemporaryFile(suffix=".jpg", delete=False)
-    temp_path = temp_file.name
-    temp_file.close()
+def crop_face(frame, box, padding=20):
+    h, w = frame.shape[:2]
+    x1, y1, x2, y2 = box
+
+    return frame[
+        max(0, y1 - padding):min(y2 + padding, h - 1),
+        max(0, x1 - padding):min(x2 + padding, w - 1)
+    ]
 
-    cv2.imwrite(temp_path, image, [cv2.IMWRITE_JPEG_QUALITY, 95])
-    return temp_path
+
+def extract_face_crops(frame, padding=20, boxes=None):
+    """
+    boxes: detect_faces output when already known
+    """
+    crops = []
+
+    if boxes is None:
+        boxes = detect_faces(faceNet, frame)
+
+    for box in boxes:
+        face = crop_face(frame, box, padding)
+
+        if face.size == 0:
+            continue
+
+        crops.append(face)
+
+    return crops
 
 
 # -----------------------------
-# Core frame-level minor check
+# Face tracking (video)
 # -----------------------------
-def is_minor_frame(frame):
-    faceBoxes = detect_faces(faceNet, frame)
+def box_iou(a, b):
+    ix = max(0, min(a[2], b[2]) - max(a[0], b[0]))
+    iy = max(0, min(a[3], b[3]) - max(a[1], b[1]))
+    inter = ix * iy
+
+    union = (
+        (a[2] - a[0]) * (a[3] - a[1])
+        + (b[2] - b[0]) * (b[3] - b[1])
+        - inter
+    )
+    return inter / union if union > 0 else 0.0
 
-    if not faceBoxes:
-        return False
 
-    padding = 20
-    h, w = frame.shape[:2]
+def centroid_close(a, b):
+    """
+    Centres closer than half the larger box side (fast motion between
+    sampled frames can drop IoU to zero for the same face)
+    """
+    dx = (a[0] + a[2] - b[0] - b[2]) / 2
+    dy = (a[1] + a[3] - b[1] - b[3]) / 2
+    side = max(a[2] - a[0], a[3] - a[1], b[2] - b[0], b[3] - b[1])
+    return (dx * dx + dy * dy) ** 0.5 < side / 2
 
-    for box in faceBoxes:
-        x1, y1, x2, y2 = box
 
-        face = frame[
-            max(0, y1 - padding):min(y2 + padding, h - 1),
-            max(0, x1 - padding):min(x2 + padding, w - 1)
-        ]
+class FaceTracker:
+    """
+    Greedy IoU association of face boxes between sampled frames, with a
+    centroid-distance fallback. update() returns, per box, its track and
+    whether that track is due an age check (new, or recheck_every
+    sampled frames since its last one).
+    """
+
+    def __init__(self, iou_threshold=MINOR_TRACK_IOU, recheck_every=MINOR_TRACK_RECHECK_EVERY, max_misses=MINOR_TRACK_MAX_MISSES):
+        self.iou_threshold = iou_threshold
+        self.recheck_every = recheck_every
+        self.max_misses = max_misses
+        self.tracks = []  # dicts: box, misses, since_check, slot
+        self.created = 0
+
+    def update(self, boxes):
+        pairs = sorted(
+            (
+                (box_iou(track["box"], box), t, b)
+                for t, track in enumerate(self.tracks)
+                for b, box in enumerate(boxes)
+            ),
+            reverse=True
+        )
+
+        matched = {}
+        used_tracks = set()
+
+        for iou, t, b in pairs:
+            if t in used_tracks or b in matched:
+                continue
+            if iou < self.iou_threshold and not centroid_close(self.tracks[t]["box"], boxes[b]):
+                continue
+            matched[b] = self.tracks[t]
+            used_tracks.add(t)
+
+        # unmatched tracks age out
+        survivors = []
+        for t, track in enumerate(self.tracks):
+            if t not in used_tracks:
+                track["misses"] += 1
+                if track["misses"] > self.max_misses:
+                    continue
+            survivors.append(track)
+        self.tracks = survivors
+
+        results = []
+        for b, box in enumerate(boxes):
+            track = matched.get(b)
+
+            if track is None:
+                track = {"box": box, "misses": 0, "since_check": 0, "slot": None}
+                self.tracks.append(track)
+                self.created += 1
+                due = True
+            else:
+                track["box"] = box
+                track["misses"] = 0
+                track["since_check"] += 1
+                due = bool(self.recheck_every) and track["since_check"] >= self.recheck_every
+
+            if due:
+                track["since_check"] = 0
+
+            results.append((track, due))
+
+        return results
 
-        if face.size == 0:
-            continue
 
-        faceBlob = cv2.dnn.blobFromImage(
-            face, 1.0, (227, 227),
+# -----------------------------
+# Batched age classification
+# -----------------------------
+def classify_ages(faces, batch_size=MINOR_AGE_BATCH_SIZE):
+    """
+    Age bucket for every face crop, stacked with blobFromImages so
+    up to batch_size faces share one ageNet forward call.
+    """
+    buckets = []
+
+    for start in range(0, len(faces), batch_size):
+        faceBlob = cv2.dnn.blobFromImages(
+            faces[start:start + batch_size], 1.0, (227, 227),
             MODEL_MEAN_VALUES,
             swapRB=False
         )
 
         ageNet.setInput(faceBlob)
         agePreds = ageNet.forward()
-        ageBucket = AGE_BUCKETS[agePreds[0].argmax()]
 
+        buckets.extend(AGE_BUCKETS[pred.argmax()] for pred in agePreds)
+
+    return buckets
+
+
+# -----------------------------
+# Core frame-level minor check
+# -----------------------------
+def is_minor_frame(frame):
+    return minor_frame_flags([frame])[0]
+
+
+def minor_frame_flags(frames, face_boxes=None):
+    """
+    Minor verdict per frame. Face crops from ALL frames are
+    classified together instead of one ageNet call per face.
+    face_boxes: optional per-frame detect_faces output
+    """
+    faces = []
+    owners = []
+
+    for idx, frame in enumerate(frames):
+        boxes = face_boxes[idx] if face_boxes is not None else None
+        for face in extract_face_crops(frame, boxes=boxes):
+            faces.append(face)
+            owners.append(idx)
+
+    flags = [False] * len(frames)
+
+    if not faces:
+        return flags
+
+    for owner, ageBucket in zip(owners, classify_ages(faces)):
         print(f"Detected age bucket: {ageBucket}")
 
-        if ageBucket in ['(0-2)', '(4-6)', '(8-12)']:
-            return True
+        if ageBucket in MINOR_AGE_BUCKETS:
+            flags[owner] = True
 
-    return False
+    return flags
 
 
 # -----------------------------
 # Image minor detection
 # -----------------------------
 def is_minor_image(image_path):
-    if not os.path.exists(image_path):
-        return False
+    return minor_image_check(image_path)[0]
 
-    img = cv2.imread(image_path)
-    if img is None:
-        return False
 
-    normalized_path = normalize_to_jpg(img)
-
-    try:
-        frame = cv2.imread(normalized_path)
-        if frame is None:
-            return False
+def minor_image_check(image_path):
+    """
+    (is_minor, face_boxes) for an image; the boxes let the NSFW skin
+    gate leave faces out without detecting them again.
+    """
+    if not os.path.exists(image_path):
+        return False, []
 
-        return is_minor_frame(frame)
+    # decoded straight to BGR, no temp-file round trip
+    frame = cv2.imread(image_path)
+    if frame is None:
+        return False, []
 
-    finally:
-        try:
-            os.remove(normalized_path)
-        except:
-            pass
+    boxes = detect_faces(faceNet, frame)
+    return minor_frame_flags([frame], [boxes])[0], boxes
 
 
 # -----------------------------
@@ -155,48 +301,156 @@ def is_minor_image(image_path):
 #     return False
 
 
-def is_minor_video(video_path, frame_skip=15, min_percent=0.50, min_frames=10):
-    """
-     Hybrid rule:
-    - OR condition
-    - If >= min_frames (default 3) detect minor → True
-    - OR if >= min_percent (default 50%) frames detect minor → True
-    """
-
-    cap = cv2.VideoCapture(video_path)
-    frame_id = 0
+# face boxes kept for face_boxes(): spans the NSFW consumer's pending batch
+RECENT_BOXES = 64
 
-    checked_frames = 0
-    minor_frames = 0
 
-    while True:
-        ret, frame = cap.read()
-        if not ret:
-            break
-
-        if frame_id % frame_skip == 0:
-            checked_frames += 1
+class MinorVideoConsumer(FrameConsumer):
+    """
+    Same hybrid rule as is_minor_video.
 
-            if is_minor_frame(frame):
-                minor_frames += 1
+    With track_faces, faces are followed across sampled frames
+    (FaceTracker) and ageNet runs once per track (plus scheduled
+    rechecks). Each age check is a verdict "slot"; a frame counts as
+    a minor frame if any face in it belongs to a minor slot.
 
-                # # ✅ CONDITION 1: at least 3 frames
-                # if minor_frames >= min_frames:
-                #     cap.release()
-                #     return True
+    face_boxes() hands the face boxes of recently sampled frames to
+    other consumers (the NSFW skin gate).
+    """
 
-        frame_id += 1
+    name = "minor"
+    # face crops need detail: full resolution unless configured
+    decode_long_side = MINOR_DECODE_LONG_SIDE
+
+    def __init__(self, frame_skip=15, min_percent=0.50, batch_size=MINOR_AGE_BATCH_SIZE, every_seconds=None, track_faces=MINOR_TRACK_FACES):
+        super().__init__(stride=frame_skip, every_seconds=every_seconds)
+        self.min_percent = min_percent
+        self.batch_size = batch_size
+        self.checked_frames = 0
+        self.minor_frames = 0
+
+        # face crops waiting for one batched ageNet call
+        self.pending_faces = []
+        self.pending_owners = []
+
+        self.tracker = FaceTracker() if track_faces else None
+        self.slot_minor = []   # verdict per age check (None = pending)
+        self.frame_slots = []  # slots seen in each sampled frame
+
+        self.recent_boxes = {}  # frame_idx → face boxes, last RECENT_BOXES frames
+        self.box_hits = 0       # face_boxes() served from recent_boxes
+        self.box_misses = 0     # face_boxes() that ran detect_faces
+
+    def remember_boxes(self, frame_idx, boxes):
+        self.recent_boxes[frame_idx] = boxes
+        if len(self.recent_boxes) > RECENT_BOXES:
+            del self.recent_boxes[next(iter(self.recent_boxes))]
+
+    def face_boxes(self, frame_idx, frame):
+        """
+        Face boxes of a decoded frame: those of the nearest frame this
+        consumer sampled within half its stride (faces barely move in
+        that time), detected otherwise.
+        """
+        nearest = min(self.recent_boxes, key=lambda idx: abs(idx - frame_idx), default=None)
+        if nearest is None or abs(nearest - frame_idx) > self.stride // 2:
+            self.box_misses += 1
+            return detect_faces(faceNet, frame)
+
+        self.box_hits += 1
+        return self.recent_boxes[nearest]
+
+    def feed(self, frame_idx, frame):
+        self.checked_frames += 1
+
+        boxes = detect_faces(faceNet, frame)
+        self.remember_boxes(frame_idx, boxes)
+
+        if self.tracker is not None:
+            self.feed_tracked(frame, boxes)
+            return
+
+        for face in extract_face_crops(frame, boxes=boxes):
+            # crops are views; copy so the decoded frame can be released
+            self.pending_faces.append(face.copy())
+            self.pending_owners.append(frame_idx)
+
+        if len(self.pending_faces) >= self.batch_size:
+            self.flush()
+
+    def feed_tracked(self, frame, detected):
+        boxes = []
+        crops = []
+        for box in detected:
+            face = crop_face(frame, box)
+            if face.size:
+                boxes.append(box)
+                crops.append(face)
+
+        slots = set()
+        for (track, due), face in zip(self.tracker.update(boxes), crops):
+            if due:
+                track["slot"] = len(self.slot_minor)
+                self.slot_minor.append(None)
+                # crops are views; copy so the decoded frame can be released
+                self.pending_faces.append(face.copy())
+                self.pending_owners.append(track["slot"])
+
+            slots.add(track["slot"])
+
+        self.frame_slots.append(slots)
+
+        if len(self.pending_faces) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending_faces:
+            return
+
+        minor_owners = set()
+        for owner, ageBucket in zip(self.pending_owners, classify_ages(self.pending_faces)):
+            print(f"Detected age bucket: {ageBucket}")
+            if self.tracker is not None:
+                self.slot_minor[owner] = ageBucket in MINOR_AGE_BUCKETS
+            elif ageBucket in MINOR_AGE_BUCKETS:
+                minor_owners.add(owner)
+
+        self.minor_frames += len(minor_owners)
+        self.pending_faces = []
+        self.pending_owners = []
+
+    def result(self):
+        self.flush()
+
+        if self.tracker is not None:
+            self.minor_frames = sum(
+                any(self.slot_minor[slot] for slot in slots)
+                for slots in self.frame_slots
+            )
+            print(
+                f"Face tracks: {self.tracker.created}, "
+                f"ageNet checks: {len(self.slot_minor)}"
+            )
+
+        if self.checked_frames == 0:
+            return False
 
-    cap.release()
+        percent = self.minor_frames / self.checked_frames
+        print(f"Minor frames: {self.minor_frames}/{self.checked_frames} ({percent:.2%})")
 
-    if checked_frames == 0:
-        return False
+        # ✅ CONDITION 2: percentage ≥ 50%
+        return percent >= self.min_percent
 
-    percent = minor_frames / checked_frames
-    print(f"Minor frames: {minor_frames}/{checked_frames} ({percent:.2%})")
 
-    # ✅ CONDITION 2: percentage ≥ 50%
-    return percent >= min_percent
+def is_minor_video(video_path, frame_skip=15, min_percent=0.50, min_frames=10):
+    """
+     Hybrid rule:
+    - OR condition
+    - If >= min_frames (default 3) detect minor → True
+    - OR if >= min_percent (default 50%) frames detect minor → True
+    """
+    consumer = MinorVideoConsumer(frame_skip, min_percent)
+    return bool(decode_shared(video_path, [consumer])["minor"])
 
 
 
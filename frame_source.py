@@ -0,0 +1,538 @@
+import json
+import shutil
+import subprocess
+from bisect import bisect_left
+
+import cv2
+import numpy as np
+
+from config import (
+    FRAME_SAMPLING, FRAME_SEEK_MIN_GAP,
+    FRAME_DECODE_BACKEND, FFMPEG_BINARY, FFPROBE_BINARY, FFMPEG_THREADS,
+    VIDEO_DECODE_MAX_LONG_SIDE
+)
+
+DEFAULT_FPS = 30.0
+
+
+# =====================================================
+# FRAME CONSUMERS
+# =====================================================
+class FrameConsumer:
+    """
+    One detector's view of a shared video decode.
+
+    - stride / offset select the frames it needs (0-based frame index);
+      every_seconds instead picks one frame per N seconds once the
+      video fps is known (see bind)
+    - max_frames caps the sample count: once the frame count is known,
+      at most max_frames indices are spread evenly over the timeline
+      (only when the stride would pick more than that)
+    - decode_short_side / decode_long_side tell decode-time scaling
+      backends (ffmpeg) the resolution this detector actually needs;
+      None = full resolution
+    - feed() receives those frames in order (never modify them in place,
+      the same array is handed to every consumer)
+    - set self.done = True to stop receiving frames (early exit)
+    - result() returns the detector verdict
+    """
+
+    name = "frames"
+    decode_short_side = None
+    decode_long_side = None
+
+    def __init__(
+        self,
+        stride: int = 1,
+        offset: int = 0,
+        every_seconds: float = None,
+        max_frames: int = None
+    ):
+        self.stride = max(1, int(stride))
+        self.offset = offset % self.stride
+        self.every_seconds = every_seconds
+        self.max_frames = max_frames
+        self.indices = None
+        self.done = False
+        self.error = None
+
+    def bind(self, fps: float, frame_count: int = 0):
+        """
+        Resolve time-based sampling into a frame stride for this video,
+        and the max_frames budget into explicit frame indices.
+        """
+        if self.every_seconds:
+            self.stride = max(1, round(self.every_seconds * fps))
+            self.offset = self.offset % self.stride
+
+        if self.max_frames and frame_count > 0:
+            strided = (frame_count - self.offset + self.stride - 1) // self.stride
+            if strided > self.max_frames:
+                self.indices = spread_indices(frame_count, self.max_frames)
+                self._index_set = set(self.indices)
+
+    def matches(self, frame_idx: int) -> bool:
+        """
+        Sampling rule alone (ignores done).
+        """
+        if self.indices is not None:
+            return frame_idx in self._index_set
+        return frame_idx % self.stride == self.offset
+
+    def wants(self, frame_idx: int) -> bool:
+        return not self.done and self.matches(frame_idx)
+
+    def next_wanted(self, frame_idx: int):
+        """
+        First frame index >= frame_idx this consumer needs (None when done).
+        """
+        if self.done:
+            return None
+
+        if self.indices is not None:
+            pos = bisect_left(self.indices, frame_idx)
+            return self.indices[pos] if pos < len(self.indices) else None
+
+        return frame_idx + (self.offset - frame_idx) % self.stride
+
+    def select_expr(self) -> str:
+        """
+        Same sampling rule as an ffmpeg select expression (n = frame index).
+        """
+        if self.indices is not None:
+            return "+".join(f"eq(n,{i})" for i in self.indices) or "0"
+        if self.stride == 1:
+            return "1"
+        return f"eq(mod(n,{self.stride}),{self.offset})"
+
+    def decode_scale(self, width: int, height: int) -> float:
+        """
+        Largest downscale factor (<= 1) that still serves this consumer.
+        """
+        if self.decode_short_side:
+            return min(1.0, self.decode_short_side / min(width, height))
+        if self.decode_long_side:
+            return min(1.0, self.decode_long_side / max(width, height))
+        return 1.0
+
+    def feed(self, frame_idx: int, frame):
+        raise NotImplementedError
+
+    def result(self):
+        raise NotImplementedError
+
+
+def spread_indices(frame_count: int, max_frames: int) -> list:
+    """
+    max_frames frame indices spread evenly over [0, frame_count)
+    (centre of each equal-length segment).
+    """
+    count = max(1, min(max_frames, frame_count))
+    return sorted({
+        min(frame_count - 1, int((i + 0.5) * frame_count / count))
+        for i in range(count)
+    })
+
+
+# =====================================================
+# SAMPLED DECODE (GRAB / SEEK)
+# =====================================================
+def video_fps(cap) -> float:
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    if not fps or fps <= 0 or fps != fps:
+        return DEFAULT_FPS
+    return fps
+
+
+def video_frame_count(cap) -> int:
+    count = cap.get(cv2.CAP_PROP_FRAME_COUNT)
+    if not count or count <= 0 or count != count:
+        return 0
+    return int(count)
+
+
+def iter_wanted_frames(cap, next_wanted, method: str = None):
+    """
+    Yield (frame_idx, frame) for the frames next_wanted() asks for.
+
+    method:
+      "grab" → skipped frames are grab()bed only (no retrieve/convert)
+      "seek" → like grab, but jumps of >= FRAME_SEEK_MIN_GAP frames
+               seek to the target instead of walking to it
+      "read" → legacy: read() every frame (benchmark baseline)
+    """
+    method = method or FRAME_SAMPLING
+    frame_idx = 0
+
+    while True:
+        target = next_wanted(frame_idx)
+        if target is None:
+            return
+
+        if method == "seek" and target - frame_idx >= FRAME_SEEK_MIN_GAP:
+            if cap.set(cv2.CAP_PROP_POS_FRAMES, target):
+                frame_idx = int(cap.get(cv2.CAP_PROP_POS_FRAMES))
+                if frame_idx > target:
+                    # landed past the target: re-plan from here
+                    continue
+
+        while frame_idx < target:
+            ok = cap.read()[0] if method == "read" else cap.grab()
+            if not ok:
+                return
+            frame_idx += 1
+
+        ret, frame = cap.read()
+        if not ret:
+            return
+
+        yield frame_idx, frame
+        frame_idx += 1
+
+
+# =====================================================
+# FFMPEG PIPE BACKEND (DECODE-TIME DOWNSCALING)
+# =====================================================
+def ffmpeg_available() -> bool:
+    return bool(shutil.which(FFMPEG_BINARY) and shutil.which(FFPROBE_BINARY))
+
+
+def probe_video(video_path: str):
+    """
+    (width, height, fps, frame_count) of the first video stream as ffmpeg
+    will output it (rotation metadata applied; frame_count 0 if unknown),
+    or None if probing fails.
+    """
+    cmd = [
+        FFPROBE_BINARY, "-v", "error",
+        "-select_streams", "v:0",
+        "-show_entries", "stream=width,height,avg_frame_rate,r_frame_rate,nb_frames,duration:stream_tags=rotate:stream_side_data=rotation",
+        "-of", "json",
+        video_path
+    ]
+
+    try:
+        info = json.loads(subprocess.run(cmd, capture_output=True, check=True, timeout=30).stdout)
+        stream = info["streams"][0]
+    except Exception as e:
+        print(f"[FRAMES] ffprobe failed for {video_path}:", e)
+        return None
+
+    width, height = int(stream["width"]), int(stream["height"])
+
+    rotation = stream.get("tags", {}).get("rotate", 0)
+    for side_data in stream.get("side_data_list", []):
+        rotation = side_data.get("rotation", rotation)
+
+    # ffmpeg auto-rotates, so portrait phone videos come out transposed
+    if abs(int(float(rotation))) % 180 == 90:
+        width, height = height, width
+
+    fps = DEFAULT_FPS
+    for key in ("avg_frame_rate", "r_frame_rate"):
+        num, _, den = stream.get(key, "0/0").partition("/")
+        try:
+            value = float(num) / float(den or 1)
+        except (ValueError, ZeroDivisionError):
+            continue
+        if value > 0:
+            fps = value
+            break
+
+    try:
+        frame_count = int(stream.get("nb_frames") or 0)
+    except ValueError:
+        frame_count = 0
+    if not frame_count:
+        try:
+            frame_count = int(float(stream.get("duration") or 0) * fps)
+        except ValueError:
+            frame_count = 0
+
+    return width, height, fps, frame_count
+
+
+def iter_ffmpeg_frames(video_path: str, width: int, height: int, select: str = "1"):
+    """
+    Stream BGR frames from an ffmpeg subprocess, already sampled by the
+    `select` expression and scaled to width x height (software decode,
+    no GPU/hardware decoder needed). Yields (output_number, frame).
+    """
+    filters = []
+    if select != "1":
+        filters.append(f"select='{select}'")
+    filters.append(f"scale={width}:{height}:flags=area")
+
+    cmd = [FFMPEG_BINARY, "-v", "error", "-nostdin"]
+    if FFMPEG_THREADS:
+        cmd += ["-threads", str(FFMPEG_THREADS)]
+    cmd += [
+        "-i", video_path,
+        "-map", "0:v:0",
+        "-vf", ",".join(filters),
+        "-vsync", "0",
+        "-f", "rawvideo",
+        "-pix_fmt", "bgr24",
+        "pipe:1"
+    ]
+
+    frame_bytes = width * height * 3
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    try:
+        number = 0
+        while True:
+            # fresh buffer per frame: consumers may keep references
+            buffer = bytearray(frame_bytes)
+            view = memoryview(buffer)
+            filled = 0
+
+            while filled < frame_bytes:
+                n = proc.stdout.readinto(view[filled:])
+                if not n:
+                    break
+                filled += n
+
+            if filled < frame_bytes:
+                return
+
+            yield number, np.frombuffer(buffer, dtype=np.uint8).reshape(height, width, 3)
+            number += 1
+
+    finally:
+        proc.stdout.close()
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+
+
+def scaled_size(width: int, height: int, scale: float):
+    if VIDEO_DECODE_MAX_LONG_SIDE:
+        scale = min(scale, VIDEO_DECODE_MAX_LONG_SIDE / max(width, height))
+    scale = min(1.0, scale)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def iter_consumer_frames_ffmpeg(video_path: str, consumers: list):
+    """
+    ffmpeg equivalent of iter_wanted_frames for a consumer set: one
+    decode, sampled to the union of the consumers' rules and scaled to
+    the largest resolution any of them needs. Yields (frame_idx, frame).
+    Falls back to the OpenCV decode when ffprobe cannot read the video.
+    """
+    probe = probe_video(video_path)
+    if probe is None:
+        print("[FRAMES] Falling back to OpenCV decode")
+        yield from iter_consumer_frames_opencv(video_path, consumers)
+        return
+
+    width, height, fps, frame_count = probe
+    for consumer in consumers:
+        consumer.bind(fps, frame_count)
+
+    scale = max(c.decode_scale(width, height) for c in consumers)
+    out_width, out_height = scaled_size(width, height, scale)
+
+    # sampling rules are fixed for the whole decode → static select
+    rules = list(consumers)
+    exprs = [c.select_expr() for c in rules]
+    select = "1" if "1" in exprs else "+".join(exprs)
+
+    print(f"[FRAMES] ffmpeg decode {width}x{height} → {out_width}x{out_height}")
+
+    frame_idx = -1
+    for _, frame in iter_ffmpeg_frames(video_path, out_width, out_height, select):
+        # map the n-th selected frame back to its source frame index
+        frame_idx += 1
+        while not any(c.matches(frame_idx) for c in rules):
+            frame_idx += 1
+
+        yield frame_idx, frame
+
+
+# =====================================================
+# STANDALONE SAMPLER
+# =====================================================
+def use_ffmpeg(backend: str = None) -> bool:
+    backend = backend or FRAME_DECODE_BACKEND
+    if backend != "ffmpeg":
+        return False
+    if not ffmpeg_available():
+        print("[FRAMES] ffmpeg/ffprobe not found, falling back to OpenCV decode")
+        return False
+    return True
+
+
+def iter_sampled_frames(
+    video_path: str,
+    stride: int = 1,
+    offset: int = 0,
+    every_seconds: float = None,
+    method: str = None,
+    backend: str = None,
+    decode_long_side: int = None,
+    max_frames: int = None
+):
+    """
+    Standalone fps-aware sampler: yields (frame_idx, frame) for every
+    stride-th frame (or one per every_seconds) without decoding the rest.
+    max_frames spreads at most that many frames over the whole video
+    (and hard-stops there if the frame count is unknown).
+    With the ffmpeg backend, frames can be downscaled at decode time.
+    """
+    spec = FrameConsumer(stride, offset, every_seconds, max_frames)
+    spec.decode_long_side = decode_long_side
+
+    if use_ffmpeg(backend):
+        frames = iter_consumer_frames_ffmpeg(video_path, [spec])
+    else:
+        frames = iter_consumer_frames_opencv(video_path, [spec], method)
+
+    try:
+        for count, (frame_idx, frame) in enumerate(frames, start=1):
+            yield frame_idx, frame
+            if max_frames and count >= max_frames:
+                return
+    finally:
+        frames.close()
+
+
+def iter_consumer_frames_opencv(video_path: str, consumers: list, method: str = None):
+    """
+    OpenCV decode for a consumer set: binds the consumers to the video,
+    then yields (frame_idx, frame) for the frames any of them wants.
+    """
+    cap = cv2.VideoCapture(video_path)
+
+    if not cap.isOpened():
+        print(f"[FRAMES] Cannot open video: {video_path}")
+        cap.release()
+        return
+
+    try:
+        fps = video_fps(cap)
+        frame_count = video_frame_count(cap)
+        for consumer in consumers:
+            consumer.bind(fps, frame_count)
+
+        def next_wanted(frame_idx):
+            targets = [
+                target for target in (c.next_wanted(frame_idx) for c in consumers)
+                if target is not None
+            ]
+            return min(targets) if targets else None
+
+        yield from iter_wanted_frames(cap, next_wanted, method)
+    finally:
+        cap.release()
+
+
+# =====================================================
+# FRAME BUDGET (BOUNDED MEMORY FOR MATERIALISED FRAMES)
+# =====================================================
+def plan_frame_budget(
+    video_path: str,
+    max_frames: int,
+    memory_limit_mb: float,
+    decode_long_side: int = None,
+    backend: str = None
+) -> int:
+    """
+    Probe size / fps / duration first and return how many frames may be
+    kept in memory: at most max_frames, and never more than fit in
+    memory_limit_mb at the decoded resolution (always at least 1).
+    """
+    if use_ffmpeg(backend):
+        probe = probe_video(video_path)
+        if probe is None:
+            return max(1, max_frames)
+        width, height, fps, frame_count = probe
+        width, height = scaled_size(
+            width, height,
+            min(1.0, decode_long_side / max(width, height)) if decode_long_side else 1.0
+        )
+    else:
+        cap = cv2.VideoCapture(video_path)
+        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        fps = video_fps(cap)
+        frame_count = video_frame_count(cap)
+        cap.release()
+
+    frame_bytes = max(1, width * height * 3)
+    memory_frames = int(memory_limit_mb * 1024 * 1024 // frame_bytes)
+    budget = max(1, min(max_frames, memory_frames))
+
+    duration = frame_count / fps if frame_count else 0
+    print(
+        f"[FRAMES] Budget {budget} frames for {width}x{height} @ {fps:.1f}fps, "
+        f"{duration:.1f}s ({frame_count} frames, limit {memory_limit_mb}MB)"
+    )
+    return budget
+
+
+# =====================================================
+# SINGLE-PASS DECODE + FAN-OUT
+# =====================================================
+def decode_shared(
+    video_path: str,
+    consumers: list,
+    prune=None,
+    method: str = None,
+    backend: str = None
+) -> dict:
+    """
+    Decode the video ONCE and hand every frame to the consumers that want it.
+    Frames nobody wants are skipped with grab()/seek (see iter_wanted_frames),
+    or never leave ffmpeg when FRAME_DECODE_BACKEND=ffmpeg.
+
+    prune: optional callable run after each frame, may mark consumers done
+           (e.g. skip checks whose verdict can no longer change the outcome).
+
+    Returns {consumer.name: consumer.result()}; a consumer that raised
+    is reported as None so callers treat it like a failed check.
+    """
+    if use_ffmpeg(backend):
+        frames = iter_consumer_frames_ffmpeg(video_path, consumers)
+    else:
+        frames = iter_consumer_frames_opencv(video_path, consumers, method)
+
+    decoded = 0
+
+    try:
+        for frame_idx, frame in frames:
+            decoded += 1
+
+            for consumer in consumers:
+                if not consumer.wants(frame_idx):
+                    continue
+                try:
+                    consumer.feed(frame_idx, frame)
+                except Exception as e:
+                    print(f"[FRAMES] {consumer.name} failed on frame {frame_idx}:", e)
+                    consumer.error = e
+                    consumer.done = True
+
+            if prune is not None:
+                prune()
+
+            if all(c.done for c in consumers):
+                break
+
+    finally:
+        frames.close()
+
+    print(f"[FRAMES] Decoded {decoded} sampled frames once for {len(consumers)} consumers")
+
+    results = {}
+    for consumer in consumers:
+        if consumer.error is not None:
+            results[consumer.name] = None
+            continue
+        try:
+            results[consumer.name] = consumer.result()
+        except Exception as e:
+            print(f"[FRAMES] {consumer.name} result failed:", e)
+            results[consumer.name] = None
+
+    return results
@@ -1,21 +1,24 @@
 import os
-import cv2
 import redis
 import time
-import json
 from pathlib import Path
 from PIL import Image
 from model import owl_model, owl_processor, DEVICE
 
 
-from face_detect.minor_detect import is_minor
-from meetup_detect.personal_details_detect import detect_personal_info  
-from violance_detect.violation_detect import is_violence_detected
-from merged_owlvit_detector import run_merged_detection
+from face_detect.minor_detect import is_minor, minor_image_check
+from meetup_detect.personal_details_detect import detect_personal_info
+from violance_detect.violation_detect import is_violence_detected, load_violence_model
+from merged_owlvit_detector import run_merged_detection, OwlFrameConsumer, OWL_INPUT_SIDE, empty_result
 from nsfw.nsfw_detector import is_nsfw
+from frame_source import plan_frame_budget
+from worker_common import run_shared_video_checks, handle_message
 
 from dynamic_update import dynamic_update
-from config import REDIS_HOST, REDIS_PORT, REDIS_DB, INPUT_QUEUE, REDIS_BRPOP_TIMEOUT
+from config import (
+    REDIS_HOST, REDIS_PORT, REDIS_DB, INPUT_QUEUE, REDIS_BRPOP_TIMEOUT, OWL_SAMPLE_SECONDS,
+    VIDEO_MAX_FRAMES, VIDEO_MAX_FRAMES_BY_EXT, VIDEO_FRAME_MEMORY_MB
+)
 
 # -----------------------------
 # Redis
@@ -94,34 +97,9 @@ def load_media(file_path):
         print("🖼️ Decoding image once in worker")
         return Image.open(file_path).convert("RGB")
 
-    # -------- VIDEO --------
-    if ext in VIDEO_EXT:
-        print("🎞️ Extracting video frames once in worker")
-        cap = cv2.VideoCapture(file_path)
-        frames = []
-        frame_id = 0
-
-        while True:
-            ret, frame = cap.read()
-            if not ret:
-                break
-
-            # sample every 20 frames
-            if frame_id % 20 == 0:
-                frames.append(
-                    Image.fromarray(
-                        cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                    )
-                )
-            frame_id += 1
-
-        cap.release()
-        return frames
-
     return None
 
 
-
 # =====================================================
 # PROCESS ONE REDIS MESSAGE
 # =====================================================
@@ -159,6 +137,29 @@ def process_redis(payload: dict):
         print("❌ File not found after normalization")
         return
 
+    # Videos are decoded once up front; images go through each detector
+    shared = None
+    ext = Path(file_path).suffix.lower()
+    if ext in VIDEO_EXT:
+        # at most K frames spread over the timeline, within the memory ceiling
+        budget = plan_frame_budget(
+            file_path,
+            max_frames=VIDEO_MAX_FRAMES_BY_EXT.get(ext, VIDEO_MAX_FRAMES),
+            memory_limit_mb=VIDEO_FRAME_MEMORY_MB,
+            decode_long_side=OWL_INPUT_SIDE
+        )
+        owl = OwlFrameConsumer(
+            owl_model, owl_processor, DEVICE,
+            stride=20,
+            every_seconds=OWL_SAMPLE_SECONDS,
+            max_frames=budget
+        )
+        shared = run_shared_video_checks(file_path, owl)
+
+    def check(name, detect, *args):
+        if shared is not None:
+            return shared[name]
+        return detect(file_path, *args)
 
 
     # -----------------------------
@@ -171,6 +172,7 @@ def process_redis(payload: dict):
     nsfw_detected = None
     violence_detected = False
     weapon_detected = False
+    face_boxes = None  # image faces, left out by the NSFW skin gate
 
 
 
@@ -179,7 +181,10 @@ def process_redis(payload: dict):
     # =====================================================
     try:
         print("🔍 Checking for minors...")
-        minor_detected = is_minor(file_path)
+        if shared is None and Path(file_path).suffix.lower() in IMAGE_EXT:
+            minor_detected, face_boxes = minor_image_check(file_path)
+        else:
+            minor_detected = check("minor", is_minor)
     except Exception as e:
         print("Minor error:", e)
 
@@ -187,7 +192,7 @@ def process_redis(payload: dict):
         if nsfw_detected is None:
             try:
                 print("🔍 Minor detected → checking NSFW...")
-                nsfw_detected = is_nsfw(file_path)
+                nsfw_detected = check("nsfw", is_nsfw, face_boxes)
             except Exception as e:
                 print("NSFW error:", e)
 
@@ -209,7 +214,7 @@ def process_redis(payload: dict):
     # =====================================================
     try:
         print("🔍 Checking for personal info...")
-        personal_info_detected = detect_personal_info(file_path)
+        personal_info_detected = check("personal_info", detect_personal_info)
     except Exception as e:
         print("PII error:", e)
 
@@ -230,21 +235,24 @@ def process_redis(payload: dict):
     # =====================================================
     print("🔍 Running merged OWL detection...")
 
-    # -----------------------------
-    # LOAD MEDIA ONCE ✅
-    # -----------------------------
-    media = load_media(file_path)
+    if shared is not None:
+        merged = shared["owl"] or empty_result()
+    else:
+        # -----------------------------
+        # LOAD MEDIA ONCE ✅
+        # -----------------------------
+        media = load_media(file_path)
 
-    if media is None:
-        print("❌ Unsupported media type")
-        return
-    
-    merged = run_merged_detection(
-        media,
-        owl_model,
-        owl_processor,
-        DEVICE
-    )
+        if media is None:
+            print("❌ Unsupported media type")
+            return
+
+        merged = run_merged_detection(
+            media,
+            owl_model,
+            owl_processor,
+            DEVICE
+        )
 
     animal_detected = merged["animal"]
     das_detected = merged["das"]
@@ -255,7 +263,7 @@ def process_redis(payload: dict):
         if nsfw_detected is None:
             try:
                 print("🔍 Animal detected → checking NSFW...")
-                nsfw_detected = is_nsfw(file_path)
+                nsfw_detected = check("nsfw", is_nsfw, face_boxes)
             except Exception as e:
                 print("NSFW error:", e)
 
@@ -281,7 +289,7 @@ def process_redis(payload: dict):
     # =====================================================
     try:
         print("🔍 Checking for violence...")
-        violence_detected = is_violence_detected(file_path)
+        violence_detected = check("violence", is_violence_detected)
     except Exception as e:
         print("Violence error:", e)
 
@@ -291,7 +299,7 @@ def process_redis(payload: dict):
     if nsfw_detected is None:
         try:
             print("🔍 Final NSFW check...")
-            nsfw_detected = is_nsfw(file_path)
+            nsfw_detected = check("nsfw", is_nsfw, face_boxes)
         except Exception as e:
             print("NSFW error:", e)
     
@@ -329,6 +337,8 @@ def process_redis(payload: dict):
 # WORKER LOOP
 # =====================================================
 def worker():
+    load_violence_model()
+
     print("🚀 Media Moderation Worker started")
     print("📥 Listening on:", INPUT_QUEUE)
 
@@ -341,13 +351,7 @@ def worker():
 
             _, message = item
 
-            try:
-                payload = json.loads(message)
-            except json.JSONDecodeError:
-                print("⚠️ Invalid JSON")
-                continue
-
-            process_redis(payload)
+            handle_message(message, process_redis)
 
         except Exception as e:
             print("❌ Worker error:", e)
@@ -0,0 +1,292 @@
+import math
+
+import cv2
+import numpy as np
+from pyzbar.pyzbar import decode as zbar_decode
+
+from config import (
+    CODE_SCAN_LOCALIZE,
+    CODE_SCAN_BARCODES,
+    CODE_SCAN_MAX_CANDIDATES
+)
+
+# =========================================================
+# Localisation settings
+# =========================================================
+# pyramid levels (long side, 0 = native resolution): small codes vanish
+# at the first ones, so frames larger than 1280 end at full resolution
+PYRAMID_SIDES = (640, 1280, 0)
+
+FINDER_MIN_SIDE = 7           # px at the pyramid level
+# finder centres of one code are at most ~24 finder sizes apart along a
+# side (version 40); the diagonal pair is linked through the corner finder
+FINDER_CLUSTER_FACTOR = 25
+FINDER_SIZE_RATIO = 2.0       # finders of one code have similar sizes
+BARCODE_MIN_AREA = 0.002      # of the pyramid level image
+BARCODE_MIN_EDGE = 40         # weaker gradient differences are never bars
+BARCODE_MAX_ASPECT = 8.0      # longer strips are text lines / edges
+BARCODE_MIN_FILL = 0.5        # of the candidate's rotated box covered by bars
+
+
+# =========================================================
+# Finder patterns (QR) / gradient bands (1D barcodes)
+# =========================================================
+def _finder_boxes(gray) -> list:
+    """
+    QR finder patterns: square contours holding a contour that holds
+    another one (the 7-5-3 nested squares).
+    """
+    binary = cv2.adaptiveThreshold(
+        gray, 255,
+        cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV,
+        51, 10
+    )
+    contours, hierarchy = cv2.findContours(binary, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+    if hierarchy is None:
+        return []
+
+    hierarchy = hierarchy[0]
+    boxes = []
+
+    for i, contour in enumerate(contours):
+        child = hierarchy[i][2]
+        if child < 0 or hierarchy[child][2] < 0:
+            continue
+
+        x, y, w, h = cv2.boundingRect(contour)
+        if min(w, h) < FINDER_MIN_SIDE or not 0.7 <= w / h <= 1.4:
+            continue
+
+        inner = cv2.contourArea(contours[hierarchy[child][2]])
+        if inner <= 0 or not 2.5 <= cv2.contourArea(contour) / inner <= 12:
+            continue
+
+        boxes.append([x, y, x + w, y + h])
+
+    return boxes
+
+
+def _cluster_finders(finders) -> list:
+    """
+    Group finder boxes belonging to the same code: finders of similar
+    size whose centres are within FINDER_CLUSTER_FACTOR × their size
+    (Euclidean), linked transitively. Each group becomes one crop
+    covering the whole code (see _code_crop).
+    """
+    centres = [((x1 + x2) / 2, (y1 + y2) / 2) for x1, y1, x2, y2 in finders]
+    sides = [max(x2 - x1, y2 - y1) for x1, y1, x2, y2 in finders]
+
+    parent = list(range(len(finders)))
+
+    def root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i in range(len(finders)):
+        for j in range(i):
+            side = max(sides[i], sides[j])
+            if side > FINDER_SIZE_RATIO * min(sides[i], sides[j]):
+                continue
+            if math.dist(centres[i], centres[j]) <= FINDER_CLUSTER_FACTOR * side:
+                parent[root(i)] = root(j)
+
+    groups = {}
+    for i in range(len(finders)):
+        groups.setdefault(root(i), []).append(i)
+
+    return [
+        _code_crop([centres[i] for i in group], max(sides[i] for i in group))
+        for group in groups.values()
+    ]
+
+
+def _code_crop(centres, side) -> list:
+    """
+    Box around one code from its finder centres, plus a quiet-zone
+    margin:
+    - three finders: the triangle plus its fourth corner
+    - two: adjacent or diagonal corners, so reach their distance
+      past them in every direction
+    - one: several finder sizes around it
+    - more: codes side by side, the box around all of them
+    """
+    points = list(centres)
+    reach = side
+
+    if len(points) == 3:
+        # the corner finder is the one opposite the longest side
+        corner = max(
+            range(3),
+            key=lambda i: math.dist(*(points[:i] + points[i + 1:]))
+        )
+        (ax, ay), (cx, cy) = points[:corner] + points[corner + 1:]
+        bx, by = points[corner]
+        points.append((ax + cx - bx, ay + cy - by))
+    elif len(points) == 2:
+        reach += math.dist(*points)
+    elif len(points) == 1:
+        reach = side * 4
+
+    xs = [x for x, _ in points]
+    ys = [y for _, y in points]
+    return [min(xs) - reach, min(ys) - reach, max(xs) + reach, max(ys) + reach]
+
+
+def _barcode_boxes(gray) -> list:
+    """
+    1D barcodes: compact, densely filled areas where one gradient
+    direction dominates.
+    """
+    grad_x = cv2.convertScaleAbs(cv2.Sobel(gray, cv2.CV_32F, 1, 0, ksize=-1))
+    grad_y = cv2.convertScaleAbs(cv2.Sobel(gray, cv2.CV_32F, 0, 1, ksize=-1))
+
+    boxes = []
+    min_area = BARCODE_MIN_AREA * gray.shape[0] * gray.shape[1]
+
+    # horizontal bars (vertical stripes) and the rotated case
+    for gradient, kernel in (
+        (cv2.subtract(grad_x, grad_y), (21, 7)),
+        (cv2.subtract(grad_y, grad_x), (7, 21))
+    ):
+        gradient = cv2.blur(gradient, (9, 9))
+        otsu, _ = cv2.threshold(gradient, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        _, bars = cv2.threshold(gradient, max(otsu, BARCODE_MIN_EDGE), 255, cv2.THRESH_BINARY)
+
+        binary = cv2.morphologyEx(
+            bars, cv2.MORPH_CLOSE,
+            cv2.getStructuringElement(cv2.MORPH_RECT, kernel)
+        )
+        binary = cv2.dilate(cv2.erode(binary, None, iterations=4), None, iterations=4)
+
+        contours, _ = cv2.findContours(binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        for contour in contours:
+            x, y, w, h = cv2.boundingRect(contour)
+            if w * h < min_area:
+                continue
+
+            (_, _), (rect_w, rect_h), _ = cv2.minAreaRect(contour)
+            if min(rect_w, rect_h) <= 0 or max(rect_w, rect_h) / min(rect_w, rect_h) > BARCODE_MAX_ASPECT:
+                continue
+
+            mask = np.zeros((h, w), dtype=np.uint8)
+            cv2.drawContours(mask, [contour - (x, y)], -1, 255, cv2.FILLED)
+            fill = cv2.countNonZero(cv2.bitwise_and(bars[y:y + h, x:x + w], mask))
+            if fill < BARCODE_MIN_FILL * rect_w * rect_h:
+                continue
+
+            pad = max(w, h) // 10
+            boxes.append([x - pad, y - pad, x + w + pad, y + h + pad])
+
+    return boxes
+
+
+def locate_codes(gray):
+    """
+    Candidate code boxes in full-resolution pixels, from the first
+    pyramid level that finds any: (qr_boxes, barcode_boxes). None when
+    there are too many candidates to be worth cropping (caller decodes
+    the whole frame).
+    """
+    h, w = gray.shape[:2]
+
+    def full_resolution(boxes, scale):
+        return [
+            [
+                max(0, int(x1 / scale)), max(0, int(y1 / scale)),
+                min(w, int(x2 / scale)), min(h, int(y2 / scale))
+            ]
+            for x1, y1, x2, y2 in boxes
+        ]
+
+    for side in PYRAMID_SIDES:
+        scale = min(1.0, side / max(h, w)) if side else 1.0
+        level = cv2.resize(
+            gray,
+            (round(w * scale), round(h * scale)),
+            interpolation=cv2.INTER_AREA
+        ) if scale < 1.0 else gray
+
+        finders = _finder_boxes(level)
+        if len(finders) > FINDER_CLUSTER_FACTOR * CODE_SCAN_MAX_CANDIDATES:
+            return None  # textured frame: clustering would cost more than zbar
+
+        qr_boxes = _cluster_finders(finders)
+        barcode_boxes = _barcode_boxes(level) if CODE_SCAN_BARCODES else []
+
+        if len(qr_boxes) + len(barcode_boxes) > CODE_SCAN_MAX_CANDIDATES:
+            return None
+
+        if qr_boxes or barcode_boxes:
+            return full_resolution(qr_boxes, scale), full_resolution(barcode_boxes, scale)
+
+        if scale == 1.0:
+            break  # already at full resolution
+
+    return [], []
+
+
+# =========================================================
+# Decode
+# =========================================================
+def _decode(image) -> list:
+    try:
+        return [
+            obj.data.decode("utf-8", errors="ignore")
+            for obj in zbar_decode(image)
+        ]
+    except Exception:
+        return []
+
+
+def scan_codes(frame) -> list:
+    """
+    QR / barcode payloads in a BGR frame. zbar runs on the crops the
+    localisation step proposes first; the whole frame is decoded when
+    localisation is off, finds too many candidates, or its crops decode
+    nothing (so no code the full-frame scan finds is lost).
+    """
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+
+    if not CODE_SCAN_LOCALIZE:
+        return _decode(gray)
+
+    located = locate_codes(gray)
+    if located is None:
+        return _decode(gray)
+
+    qr_boxes, barcode_boxes = located
+
+    payloads = []
+    for x1, y1, x2, y2 in qr_boxes + barcode_boxes:
+        if x2 <= x1 or y2 <= y1:
+            continue
+        for payload in _decode(gray[y1:y2, x1:x2]):
+            if payload not in payloads:
+                payloads.append(payload)
+
+    if not payloads:
+        # a missed or badly cropped code must not be lost
+        return _decode(gray)
+
+    return payloads
+
+
+class CodeScanner:
+    """
+    Per-video scanner: new_payloads() returns only payloads not seen
+    earlier in the same video, so a code on screen for many sampled
+    frames is checked once.
+    """
+
+    def __init__(self):
+        self.seen = set()
+
+    def new_payloads(self, frame) -> list:
+        fresh = []
+        for payload in scan_codes(frame):
+            if payload not in self.seen:
+                self.seen.add(payload)
+                fresh.append(payload)
+        return fresh
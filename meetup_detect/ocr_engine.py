@@ -0,0 +1,128 @@
+import atexit
+import threading
+
+import cv2
+import numpy as np
+import pytesseract
+from PIL import Image
+
+from config import OCR_BACKEND, OCR_LANG, OCR_TESSDATA_PATH, OCR_PSM, OCR_PREPROCESS
+
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
+
+# =========================================================
+# Backend selection
+# =========================================================
+USE_TESSEROCR = tesserocr is not None and OCR_BACKEND in ("auto", "tesserocr")
+
+if OCR_BACKEND == "tesserocr" and tesserocr is None:
+    print("⚠️ OCR_BACKEND=tesserocr but tesserocr is not installed, using pytesseract")
+
+print("[OCR] Backend:", "tesserocr (in-process)" if USE_TESSEROCR else "pytesseract (subprocess)")
+
+# =========================================================
+# Engine pool (one long-lived Tesseract API per thread)
+# =========================================================
+_local = threading.local()
+_engines = []
+_engines_lock = threading.Lock()
+
+
+def _engine():
+    """
+    This thread's Tesseract engine: language data is loaded once, on
+    first use, instead of once per call.
+    """
+    api = getattr(_local, "api", None)
+
+    if api is None:
+        kwargs = {"lang": OCR_LANG, "psm": OCR_PSM}
+        if OCR_TESSDATA_PATH:
+            kwargs["path"] = OCR_TESSDATA_PATH
+
+        api = tesserocr.PyTessBaseAPI(**kwargs)
+        _local.api = api
+
+        with _engines_lock:
+            _engines.append(api)
+
+    return api
+
+
+def close_engines():
+    """
+    Release every thread's engine (worker shutdown).
+    """
+    with _engines_lock:
+        for api in _engines:
+            api.End()
+        _engines.clear()
+
+    _local.__dict__.clear()
+
+
+atexit.register(close_engines)
+
+
+# =========================================================
+# Preprocessing
+# =========================================================
+def prepare_image(image, mode=OCR_PREPROCESS) -> np.ndarray:
+    """
+    BGR ndarray (decoded frame) or PIL image → RGB or single-channel
+    uint8 array for OCR, after the configured preprocessing.
+    """
+    if isinstance(image, Image.Image):
+        rgb = np.asarray(image.convert("RGB"))
+        bgr = None
+    else:
+        rgb = None
+        bgr = image
+
+    if mode == "none":
+        return rgb if rgb is not None else cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
+
+    gray = (
+        cv2.cvtColor(rgb, cv2.COLOR_RGB2GRAY)
+        if rgb is not None
+        else cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY)
+    )
+
+    if mode == "otsu":
+        _, gray = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    elif mode == "adaptive":
+        gray = cv2.adaptiveThreshold(
+            gray, 255,
+            cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY,
+            31, 10
+        )
+
+    return gray
+
+
+# =========================================================
+# OCR
+# =========================================================
+def ocr_text(image) -> str:
+    """
+    Text in a BGR frame or PIL image. In-process engine when available
+    (pixels handed over directly), pytesseract otherwise.
+    """
+    pixels = np.ascontiguousarray(prepare_image(image))
+
+    if USE_TESSEROCR:
+        height, width = pixels.shape[:2]
+        channels = 1 if pixels.ndim == 2 else pixels.shape[2]
+
+        api = _engine()
+        api.SetImageBytes(pixels.tobytes(), width, height, channels, width * channels)
+        return api.GetUTF8Text()
+
+    return pytesseract.image_to_string(
+        Image.fromarray(pixels),
+        lang=OCR_LANG,
+        config=f"--psm {OCR_PSM}"
+    )
@@ -7,13 +7,27 @@ import requests
 from io import BytesIO
 import os
 import cv2
+import hashlib
+import threading
 import numpy as np
-from pyzbar.pyzbar import decode as qr_decode
+from collections import OrderedDict
+
+from config import (
+    PII_DECODE_LONG_SIDE,
+    PII_TEXT_GATE,
+    PII_TEXT_MAX_REGIONS,
+    PII_OCR_CACHE_SIZE,
+    PII_NER_BATCH_SIZE
+)
+from frame_source import FrameConsumer, decode_shared
+from meetup_detect.ocr_engine import ocr_text
+from meetup_detect.code_scanner import CodeScanner, scan_codes
 
 # =========================================================
 # Load NLP model (ONCE)
 # =========================================================
-nlp = spacy.load("en_core_web_sm")
+# only the entity recognizer is used (hasAddress)
+nlp = spacy.load("en_core_web_sm", enable=["ner"])
 
 # =========================================================
 # Regex patterns
@@ -85,39 +99,301 @@ def hasForbiddenURL(text: str) -> bool:
 
 
 def hasAddress(text: str) -> bool:
-    doc = nlp(text)
+    return docHasAddress(nlp(text))
+
+
+def docHasAddress(doc) -> bool:
     for ent in doc.ents:
         if ent.label_ in {"GPE", "LOC", "FAC"}:
             return True
     return False
 
 
+# =========================================================
+# Combined pattern pass (email / URL / phone / number words)
+# =========================================================
+# One scan instead of four. Alternatives at the same position are tried
+# in this order; the word alternative yields every word, checked
+# against number_words like hasNumberWords does.
+_pattern_parts = [
+    ("email", email_pattern.pattern),
+    ("url", url_pattern.pattern),
+    ("phone", phone_pattern.pattern),
+    ("word", r'\b[a-zA-Z]+\b')
+]
+
+pii_pattern = re.compile(
+    "|".join(f"(?P<{name}>{pattern})" for name, pattern in _pattern_parts)
+)
+pii_pattern_no_url = re.compile(
+    "|".join(f"(?P<{name}>{pattern})" for name, pattern in _pattern_parts if name != "url")
+)
+
+
+def isForbiddenURL(url: str) -> bool:
+    url = url.rstrip('.,!?')
+    if not re.search(r'\.[a-zA-Z]{2,}', url):
+        return False
+    return PLATFORM_DOMAIN not in url
+
+
+def _pattern_hit(match) -> bool:
+    kind = match.lastgroup
+    if kind == "word":
+        return match.group(kind).lower() in number_words
+    if kind == "url":
+        return isForbiddenURL(match.group(kind))
+    return True  # any email / phone match
+
+
+def hasPatternMatch(text: str) -> bool:
+    """
+    hasForbiddenURL or isEmail or hasPhoneNumber or hasNumberWords,
+    in one regex pass.
+
+    A match that is not a hit only consumes its first character, so
+    nothing overlapping it is missed. URL matches keep hasForbiddenURL's
+    non-overlapping scan (a URL starting inside the previous URL match
+    is ignored), and the other alternatives are still tried where a URL
+    matched.
+    """
+    pos = 0
+    url_end = 0
+
+    while True:
+        match = pii_pattern.search(text, pos)
+        if match is None:
+            return False
+
+        start = match.start()
+
+        if match.lastgroup == "url":
+            if start >= url_end:
+                if isForbiddenURL(match.group("url")):
+                    return True
+                url_end = match.end()
+
+            other = pii_pattern_no_url.match(text, start)
+            if other is not None and _pattern_hit(other):
+                return True
+
+        elif _pattern_hit(match):
+            return True
+
+        pos = start + 1
+
+
 # =========================================================
 # Core decision logic
 # =========================================================
+def isCheapPersonalDetails(text: str) -> bool:
+    """
+    Every rule except the NER one, cheapest first
+    """
+    return hasNumber(text) or hasPatternMatch(text)
+
+
 def isPersonalDetails(text: str) -> bool:
-    return any([
-        hasForbiddenURL(text),
-        isEmail(text),
-        hasPhoneNumber(text),
-        hasNumberWords(text),
-        hasNumber(text),
-        hasAddress(text)
-    ])
+    # cost order, stops at the first hit: digits → one regex pass → NER
+    return isCheapPersonalDetails(text) or hasAddress(text)
+
+
+def personalDetailsBatch(texts: list) -> list:
+    """
+    isPersonalDetails for many texts: the cheap rules per text, then one
+    batched nlp.pipe over the texts they did not flag.
+    """
+    flags = [isCheapPersonalDetails(text) for text in texts]
+    pending = [i for i, flag in enumerate(flags) if not flag and texts[i]]
+
+    docs = nlp.pipe((texts[i] for i in pending), batch_size=PII_NER_BATCH_SIZE)
+    for i, doc in zip(pending, docs):
+        flags[i] = docHasAddress(doc)
+
+    return flags
+
+
+# =========================================================
+# Text-region gate (before OCR)
+# =========================================================
+TEXT_GATE_SIDE = 1280      # region search runs on at most this long side
+TEXT_MIN_EDGE = 16         # compression noise; faint (~20 grey level) text stays above it
+TEXT_REGION_PADDING = 6
+TEXT_FULL_FRAME_COVER = 0.5
+
+_text_gate_lock = threading.Lock()
+_ocr_cache = OrderedDict()
+_text_gate_stats = {
+    "frames": 0,       # images / frames through the gate
+    "skipped": 0,      # no text-like region → no OCR
+    "full_frame": 0,   # too many / too large regions → whole frame OCR'd
+    "regions": 0,      # region crops OCR'd or served from cache
+    "cache_hits": 0
+}
+
+
+def text_gate_stats() -> dict:
+    """
+    Snapshot of the text gate / OCR cache counters since process start
+    """
+    with _text_gate_lock:
+        return dict(_text_gate_stats)
+
+
+def _count(key, n=1):
+    with _text_gate_lock:
+        _text_gate_stats[key] += n
+
+
+def find_text_regions(frame) -> list:
+    """
+    Candidate text boxes [x1, y1, x2, y2] in a BGR frame: morphological
+    gradient → binarise (Otsu, floored at TEXT_MIN_EDGE) → close
+    horizontally so characters join into lines → line-shaped contours.
+    """
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+
+    h, w = gray.shape[:2]
+    scale = min(1.0, TEXT_GATE_SIDE / max(h, w))
+    if scale < 1.0:
+        gray = cv2.resize(gray, (round(w * scale), round(h * scale)), interpolation=cv2.INTER_AREA)
+
+    gradient = cv2.morphologyEx(
+        gray, cv2.MORPH_GRADIENT,
+        cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3))
+    )
+    otsu, _ = cv2.threshold(gradient, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    _, edges = cv2.threshold(gradient, max(otsu, TEXT_MIN_EDGE), 255, cv2.THRESH_BINARY)
+
+    lines = cv2.morphologyEx(
+        edges, cv2.MORPH_CLOSE,
+        cv2.getStructuringElement(cv2.MORPH_RECT, (9, 1))
+    )
+    contours, _ = cv2.findContours(lines, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    small_h = gray.shape[0]
+    boxes = []
+
+    for contour in contours:
+        x, y, bw, bh = cv2.boundingRect(contour)
+
+        # glyph-sized line: not a speck, not a large photo edge
+        if bh < 8 or bw < 8 or bh > small_h * 0.5:
+            continue
+
+        # strokes fill a fair share of a text line's box
+        if cv2.countNonZero(edges[y:y + bh, x:x + bw]) < 0.2 * bw * bh:
+            continue
+
+        boxes.append([
+            max(0, int((x - TEXT_REGION_PADDING) / scale)),
+            max(0, int((y - TEXT_REGION_PADDING) / scale)),
+            min(w, int((x + bw + TEXT_REGION_PADDING) / scale)),
+            min(h, int((y + bh + TEXT_REGION_PADDING) / scale))
+        ])
+
+    return boxes
+
+
+def merge_boxes(boxes: list) -> list:
+    """
+    Union overlapping boxes until none overlap (so a line is OCR'd once)
+    """
+    merged = [list(box) for box in boxes]
+    changed = True
+
+    while changed:
+        changed = False
+        result = []
+
+        for box in merged:
+            for other in result:
+                if box[0] <= other[2] and other[0] <= box[2] and box[1] <= other[3] and other[1] <= box[3]:
+                    other[0], other[1] = min(box[0], other[0]), min(box[1], other[1])
+                    other[2], other[3] = max(box[2], other[2]), max(box[3], other[3])
+                    changed = True
+                    break
+            else:
+                result.append(box)
+
+        merged = result
+
+    return merged
+
+
+def _crop_key(crop) -> bytes:
+    """
+    Exact key: full-resolution pixels and shape. The cache is shared by
+    every upload in the process, so only identical crops (static scenes,
+    re-sent images) may reuse another crop's text.
+    """
+    crop = np.ascontiguousarray(crop)
+    return hashlib.blake2b(
+        crop.tobytes() + repr(crop.shape).encode(),
+        digest_size=16
+    ).digest()
+
+
+def cached_ocr_text(crop) -> str:
+    key = _crop_key(crop)
+
+    with _text_gate_lock:
+        text = _ocr_cache.get(key)
+        if text is not None:
+            _ocr_cache.move_to_end(key)
+            _text_gate_stats["cache_hits"] += 1
+            return text
+
+    text = ocr_text(crop)
+
+    with _text_gate_lock:
+        _ocr_cache[key] = text
+        if len(_ocr_cache) > PII_OCR_CACHE_SIZE:
+            _ocr_cache.popitem(last=False)
+
+    return text
+
+
+def gated_ocr_text(frame) -> str:
+    """
+    OCR text of a BGR frame through the text-region gate: "" without
+    running OCR when no text-like region is found, otherwise the
+    (cached) text of each region, or of the whole frame when regions
+    are too many or cover most of it.
+    """
+    if not PII_TEXT_GATE:
+        return ocr_text(frame)
+
+    _count("frames")
+    boxes = find_text_regions(frame)
+
+    if not boxes:
+        _count("skipped")
+        return ""
+
+    if len(boxes) <= PII_TEXT_MAX_REGIONS:
+        boxes = merge_boxes(boxes)
+
+    covered = sum((x2 - x1) * (y2 - y1) for x1, y1, x2, y2 in boxes)
+    if len(boxes) > PII_TEXT_MAX_REGIONS or covered > TEXT_FULL_FRAME_COVER * frame.shape[0] * frame.shape[1]:
+        _count("full_frame")
+        return cached_ocr_text(frame)
+
+    _count("regions", len(boxes))
+
+    # top-to-bottom, left-to-right: keeps multi-line text in reading order
+    return "\n".join(
+        cached_ocr_text(frame[y1:y2, x1:x2])
+        for x1, y1, x2, y2 in sorted(boxes, key=lambda box: (box[1], box[0]))
+    )
 
 
 # =========================================================
 # QR helpers
 # =========================================================
 def extract_qr_from_frame(frame) -> list[str]:
-    try:
-        decoded = qr_decode(frame)
-        return [
-            obj.data.decode("utf-8", errors="ignore")
-            for obj in decoded
-        ]
-    except Exception:
-        return []
+    # localised QR / barcode scan (see code_scanner)
+    return scan_codes(frame)
 
 
 # =========================================================
@@ -134,9 +410,9 @@ def extract_text_and_qr_from_file(file_path_or_url: str) -> tuple[str, list]:
         else:
             img = Image.open(file_path_or_url)
 
-        text = pytesseract.image_to_string(img)
+        frame = cv2.cvtColor(np.array(img.convert("RGB")), cv2.COLOR_RGB2BGR)
 
-        frame = cv2.cvtColor(np.array(img), cv2.COLOR_RGB2BGR)
+        text = gated_ocr_text(frame)
         qr_payloads = extract_qr_from_frame(frame)
 
     except Exception as e:
@@ -148,38 +424,86 @@ def extract_text_and_qr_from_file(file_path_or_url: str) -> tuple[str, list]:
 # =========================================================
 # OCR + QR (Video)
 # =========================================================
-def detect_personal_info_video(video_path, frame_skip=30) -> bool:
+def frame_has_personal_info(frame) -> bool:
+    text = gated_ocr_text(frame)
+    qr_payloads = extract_qr_from_frame(frame)
+
+    if text and isPersonalDetails(text):
+        return True
+
+    for qr_text in qr_payloads:
+        if isPersonalDetails(qr_text):
+            return True
+
+    return False
+
+
+class PersonalInfoVideoConsumer(FrameConsumer):
     """
-    frame_skip=30 → ~1 frame/sec for 30fps video
+    Stops at the first frame with personal info.
+
+    The cheap rules run per frame; texts they do not flag wait for one
+    batched NER pass every ner_batch_size texts (and at the end).
     """
-    if not os.path.exists(video_path):
-        return False
 
-    cap = cv2.VideoCapture(video_path)
-    frame_id = 0
+    name = "personal_info"
+    # OCR needs detail: full resolution unless configured
+    decode_long_side = PII_DECODE_LONG_SIDE
 
-    while True:
-        ret, frame = cap.read()
-        if not ret:
-            break
+    def __init__(self, frame_skip=30, every_seconds=None, ner_batch_size=PII_NER_BATCH_SIZE):
+        super().__init__(stride=frame_skip, every_seconds=every_seconds)
+        self.detected = False
+        self.ner_batch_size = max(1, ner_batch_size)
+        self.pending_texts = []
+        # payloads already checked in this video are skipped
+        self.code_scanner = CodeScanner()
 
-        if frame_id % frame_skip == 0:
-            text = pytesseract.image_to_string(Image.fromarray(frame))
-            qr_payloads = extract_qr_from_frame(frame)
+    def feed(self, frame_idx, frame):
+        texts = [gated_ocr_text(frame)] + self.code_scanner.new_payloads(frame)
 
-            if text and isPersonalDetails(text):
-                cap.release()
-                return True
+        for text in texts:
+            if not text:
+                continue
 
-            for qr_text in qr_payloads:
-                if isPersonalDetails(qr_text):
-                    cap.release()
-                    return True
+            if isCheapPersonalDetails(text):
+                self.detected = True
+                self.done = True
+                return
 
-        frame_id += 1
+            self.pending_texts.append(text)
 
-    cap.release()
-    return False
+        if len(self.pending_texts) >= self.ner_batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending_texts:
+            return
+
+        docs = nlp.pipe(self.pending_texts, batch_size=self.ner_batch_size)
+        self.pending_texts = []
+
+        if any(docHasAddress(doc) for doc in docs):
+            self.detected = True
+            self.done = True
+
+    def result(self):
+        if not self.done:
+            self.flush()
+
+        if PII_TEXT_GATE:
+            print("[PII][TEXT GATE] Totals:", text_gate_stats())
+        return self.detected
+
+
+def detect_personal_info_video(video_path, frame_skip=30) -> bool:
+    """
+    frame_skip=30 → ~1 frame/sec for 30fps video
+    """
+    if not os.path.exists(video_path):
+        return False
+
+    consumer = PersonalInfoVideoConsumer(frame_skip)
+    return bool(decode_shared(video_path, [consumer])["personal_info"])
 
 
 # =========================================================
@@ -208,14 +532,7 @@ def detect_personal_info(data) -> bool:
         # Image / URL
         text, qr_payloads = extract_text_and_qr_from_file(data)
 
-        if isPersonalDetails(text):
-            return True
-
-        for qr_text in qr_payloads:
-            if isPersonalDetails(qr_text):
-                return True
-
-        return False
+        return any(personalDetailsBatch([text] + qr_payloads))
 
     # -----------------------------
     # DICT INPUT
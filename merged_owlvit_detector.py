@@ -1,4 +1,18 @@
+from itertools import islice
+
+import cv2
+import numpy as np
 import torch
+from PIL import Image
+
+from config import (
+    OWL_CACHE_TEXT_QUERIES,
+    OWL_BATCH_SIZE,
+    OWL_FAST_PREPROCESS,
+    OWL_PREPROCESS_TOLERANCE,
+    OWL_PREPROCESS_MAX_TOLERANCE
+)
+from frame_source import FrameConsumer
 
 # =====================================================
 # MERGED LABEL SET
@@ -30,6 +44,9 @@ ALL_LABELS = (
     WEAPON_LABELS
 )
 
+# OWL-V2 pads to square and resizes to this side
+OWL_INPUT_SIDE = 960
+
 # =====================================================
 # PER-CLASS THRESHOLDS (SOURCE OF TRUTH)
 # =====================================================
@@ -89,64 +106,502 @@ def get_threshold(label: str) -> float:
 
 
 # =====================================================
-# CORE MERGED DETECTOR
+# PER-QUERY THRESHOLD / CATEGORY TENSORS
 # =====================================================
-def run_merged_detection(media, model, processor, device):
+CATEGORIES = ("animal", "das", "weapon")
+
+
+def _label_category(label: str) -> int:
+    if label in ANIMAL_LABELS:
+        return 0
+    if label in DAS_LABELS:
+        return 1
+    if label in WEAPON_LABELS:
+        return 2
+    return 0  # unreachable for ALL_LABELS; threshold 1.0 never fires
+
+
+QUERY_THRESHOLDS = torch.tensor([get_threshold(label) for label in ALL_LABELS])
+QUERY_CATEGORIES = torch.tensor([_label_category(label) for label in ALL_LABELS])
+
+
+def category_max_scores(logits):
     """
-    media: PIL.Image OR list[PIL.Image]
+    Raw OWL-V2 class logits [B, boxes, Q] → per-category max score [B, 3]
+    in one tensor pass (0.0 = category not detected).
+
+    Same rule as post_process_object_detection + get_threshold: each box
+    keeps its best query, and counts if sigmoid(score) >= that query's
+    threshold (all per-class thresholds are above the old 0.25 cut).
     """
+    best_logits, best_queries = logits.max(dim=-1)
+    scores = torch.sigmoid(best_logits.float())
 
-    frames = media if isinstance(media, list) else [media]
+    thresholds = QUERY_THRESHOLDS.to(scores.device)[best_queries]
+    categories = QUERY_CATEGORIES.to(scores.device)[best_queries]
 
-    result = {
-        "animal": False,
-        "das": False,
-        "weapon": False
-    }
+    hits = torch.where(scores >= thresholds, scores, torch.zeros_like(scores))
 
-    for image in frames:
-        inputs = processor(
+    return torch.zeros(
+        (scores.shape[0], len(CATEGORIES)),
+        dtype=scores.dtype,
+        device=scores.device
+    ).scatter_reduce(1, categories, hits, reduce="amax")
+
+
+def category_results(max_scores):
+    """
+    [B, 3] category max scores → one result dict per frame:
+    {"animal": bool, "das": bool, "weapon": bool, "scores": {category: float}}
+    """
+    results = []
+
+    for row in max_scores.cpu().tolist():
+        result = {
+            category: score > 0
+            for category, score in zip(CATEGORIES, row)
+        }
+        result["scores"] = dict(zip(CATEGORIES, row))
+        results.append(result)
+
+    return results
+
+
+def empty_result():
+    result = {category: False for category in CATEGORIES}
+    result["scores"] = {category: 0.0 for category in CATEGORIES}
+    return result
+
+
+def merge_results(merged, frame_result):
+    """
+    OR the flags / max the scores of frame_result into merged (in place).
+    """
+    for category in CATEGORIES:
+        merged[category] = merged[category] or frame_result[category]
+        merged["scores"][category] = max(
+            merged["scores"][category],
+            frame_result["scores"][category]
+        )
+    return merged
+
+
+def all_found(result) -> bool:
+    return all(result[category] for category in CATEGORIES)
+
+
+# =====================================================
+# TEXT QUERY CACHE (LABELS NEVER CHANGE)
+# =====================================================
+_TEXT_QUERY_CACHE = {}
+
+def encode_text_queries(model, processor, device):
+    """
+    Run the OWL-V2 text tower over ALL_LABELS once per model/device.
+    Returns (query_embeds [1, Q, D], query_mask [1, Q]).
+    """
+    key = (id(model), str(device))
+
+    if key not in _TEXT_QUERY_CACHE:
+        print(f"[OWL] Encoding {len(ALL_LABELS)} label queries once")
+
+        text_inputs = processor(
             text=ALL_LABELS,
-            images=image,
             return_tensors="pt"
         ).to(device)
 
         with torch.no_grad():
-            outputs = model(**inputs)
+            query_embeds = model.owlv2.get_text_features(
+                input_ids=text_inputs["input_ids"],
+                attention_mask=text_inputs["attention_mask"]
+            )
+
+        # same padding rule as Owlv2ForObjectDetection.forward
+        query_mask = text_inputs["input_ids"][:, 0] > 0
+
+        _TEXT_QUERY_CACHE[key] = (
+            query_embeds.unsqueeze(0),
+            query_mask.unsqueeze(0)
+        )
+
+    return _TEXT_QUERY_CACHE[key]
+
+
+def detect_with_cached_queries(model, pixel_values, query_embeds, query_mask):
+    """
+    Vision tower + class head only, against pre-encoded queries.
+    Mirrors Owlv2ForObjectDetection.forward without the text tower
+    (and without the box head: only class logits are used).
+    Returns class logits [B, boxes, Q].
+    """
+    feature_map = model.image_embedder(pixel_values=pixel_values)[0]
+
+    batch_size, num_patches_height, num_patches_width, hidden_dim = feature_map.shape
+    image_feats = torch.reshape(
+        feature_map,
+        (batch_size, num_patches_height * num_patches_width, hidden_dim)
+    )
+
+    pred_logits, _ = model.class_predictor(
+        image_feats,
+        query_embeds.expand(batch_size, -1, -1),
+        query_mask.expand(batch_size, -1)
+    )
+
+    return pred_logits
+
+
+# =====================================================
+# FAST PREPROCESSING (OPENCV / NUMPY)
+# =====================================================
+class OwlPreprocessor:
+    """
+    OpenCV/numpy version of Owlv2ImageProcessor (rescale → pad to square
+    with 0.5 at bottom/right → anti-aliased bilinear resize → normalise).
+
+    Accepts PIL images (RGB) or BGR uint8 arrays straight from the video
+    decoder. Writes into a reusable [B, 3, S, S] buffer: the returned
+    tensor is only valid until the next call.
+    """
+
+    def __init__(self, processor):
+        image_processor = getattr(processor, "image_processor", processor)
+
+        self.side = image_processor.size["height"]
+        self.mean = np.asarray(image_processor.image_mean, dtype=np.float32)
+        self.std = np.asarray(image_processor.image_std, dtype=np.float32)
+
+        self.batch = torch.empty((0, 3, self.side, self.side), dtype=torch.float32)
+        self.resized = np.empty((self.side, self.side, 3), dtype=np.float32)
+        self.square = np.empty((0, 0, 3), dtype=np.float32)
+
+    def _batch(self, batch_size):
+        if self.batch.shape[0] < batch_size:
+            self.batch = torch.empty(
+                (batch_size, 3, self.side, self.side),
+                dtype=torch.float32
+            )
+        return self.batch[:batch_size].numpy()
+
+    def _square(self, side):
+        # frames of one video share a size: reallocated only on change
+        if self.square.shape[0] != side:
+            self.square = np.empty((side, side, 3), dtype=np.float32)
+        return self.square
+
+    def __call__(self, images):
+        batch = self._batch(len(images))
+
+        for i, image in enumerate(images):
+            if isinstance(image, np.ndarray):
+                rgb = image[..., ::-1]  # BGR → RGB, no copy
+            else:
+                rgb = np.asarray(image.convert("RGB"))
+
+            height, width = rgb.shape[:2]
+            padded = self._square(max(height, width))
+
+            # rescale + pad in one write
+            padded.fill(0.5)
+            np.multiply(rgb, 1 / 255, out=padded[:height, :width], casting="unsafe")
+
+            # skimage-style anti-aliasing before a downscale
+            sigma = max(0.0, (padded.shape[0] / self.side - 1) / 2)
+            if sigma > 0:
+                padded = cv2.GaussianBlur(
+                    padded,
+                    (2 * int(4 * sigma + 0.5) + 1,) * 2,
+                    sigmaX=sigma,
+                    borderType=cv2.BORDER_REFLECT_101
+                )
+
+            cv2.resize(
+                padded,
+                (self.side, self.side),
+                dst=self.resized,
+                interpolation=cv2.INTER_LINEAR
+            )
+
+            self.resized -= self.mean
+            self.resized /= self.std
+            batch[i] = self.resized.transpose(2, 0, 1)
+
+        return self.batch[:len(images)]
+
+
+_PREPROCESSORS = {}
+
+
+def fast_preprocessor(processor):
+    """
+    OwlPreprocessor for this HF processor, or None when the fast path is
+    disabled or failed its parity check (see check_fast_preprocess).
+    """
+    if not OWL_FAST_PREPROCESS:
+        return None
+
+    key = id(processor)
+    if key not in _PREPROCESSORS:
+        _PREPROCESSORS[key] = OwlPreprocessor(processor)
 
-        target_sizes = torch.tensor(
-            [image.size[::-1]]
+    return _PREPROCESSORS[key]
+
+
+# (width, height, textured) images the fast path must reproduce: below
+# the 960 input side both are upscaled, 1280x720 is downscaled (blurred)
+PREPROCESS_PARITY_IMAGES = [
+    (720, 540, False),
+    (720, 540, True),
+    (640, 480, True),
+    (1280, 720, True)
+]
+
+
+def check_fast_preprocess(processor, tolerance=None, max_tolerance=None):
+    """
+    Compare OwlPreprocessor against the HF processor on synthetic
+    non-square images (smooth and textured, upscaled and downscaled).
+    Disables the fast path for this processor if any image's mean
+    absolute difference exceeds tolerance or its largest single-pixel
+    difference exceeds max_tolerance. Returns True if it passed.
+    """
+    preprocessor = fast_preprocessor(processor)
+    if preprocessor is None:
+        return False
+
+    tolerance = OWL_PREPROCESS_TOLERANCE if tolerance is None else tolerance
+    max_tolerance = OWL_PREPROCESS_MAX_TOLERANCE if max_tolerance is None else max_tolerance
+
+    passed = True
+
+    for seed, (width, height, textured) in enumerate(PREPROCESS_PARITY_IMAGES):
+        pil_image = (textured_image if textured else synthetic_image)(width, height, seed)
+
+        expected = processor(images=[pil_image], return_tensors="pt")["pixel_values"]
+        actual = preprocessor([pil_image]).clone()
+
+        diff = (expected.float() - actual).abs()
+        mean_diff = diff.mean().item()
+        max_diff = diff.max().item()
+
+        print(
+            f"[OWL] Fast preprocess parity {width}x{height}"
+            f"{' textured' if textured else ''}: mean |diff|={mean_diff:.5f}, "
+            f"max |diff|={max_diff:.5f} (tolerance {tolerance} / {max_tolerance})"
+        )
+
+        if mean_diff > tolerance or max_diff > max_tolerance:
+            passed = False
+
+    if not passed:
+        print("[OWL] ⚠️ Fast preprocess disabled, using HF processor")
+        _PREPROCESSORS[id(processor)] = None
+
+    return passed
+
+
+def synthetic_image(width, height, seed=0):
+    """
+    Deterministic RGB test image for parity checks: smooth gradients and
+    a few shapes, no pixel noise (see textured_image for that).
+    """
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    image = np.stack([
+        255 * x / width,
+        255 * y / height,
+        127 + 100 * np.sin(x / rng.uniform(20, 60)) * np.cos(y / rng.uniform(20, 60))
+    ], axis=-1).astype(np.uint8)
+
+    for _ in range(3):
+        center = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        color = tuple(int(c) for c in rng.integers(0, 256, 3))
+        cv2.circle(image, center, int(rng.integers(20, min(width, height) // 3)), color, -1)
+
+    return Image.fromarray(image)
+
+
+def textured_image(width, height, seed=0):
+    """
+    Deterministic RGB test image with pixel-level texture (noise with
+    4px and 16px blocks pasted over it): exposes interpolation and
+    anti-aliasing differences that smooth images hide.
+    """
+    rng = np.random.default_rng(seed)
+    image = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+
+    for block in (4, 16):
+        coarse = rng.integers(0, 256, (height // block + 1, width // block + 1, 3), dtype=np.uint8)
+        tiles = np.repeat(np.repeat(coarse, block, axis=0), block, axis=1)[:height, :width]
+        image[tiles[..., 0] < 85] = tiles[tiles[..., 0] < 85]
+
+    return Image.fromarray(image)
+
+
+def preprocess_images(images, processor, device):
+    """
+    images: list of PIL images and/or BGR arrays → pixel_values on device.
+    """
+    preprocessor = fast_preprocessor(processor)
+
+    if preprocessor is not None:
+        return preprocessor(images).to(device)
+
+    return processor(
+        images=[_hf_image(image) for image in images],
+        return_tensors="pt"
+    )["pixel_values"].to(device)
+
+
+def _hf_image(image):
+    if isinstance(image, np.ndarray):
+        return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    return image
+
+
+# =====================================================
+# BATCHED FORWARD PASS
+# =====================================================
+def detect_batch(images, model, processor, device):
+    """
+    images: list of PIL images (RGB) and/or BGR arrays → one preprocessing
+    call, one forward pass, one vectorized thresholding pass. Returns one
+    result per image: category flags plus per-category max scores
+    (see category_results).
+    """
+    if hasattr(model, "class_logits"):
+        # exported / compiled backend (see owl_backends): queries baked in
+        logits = model.class_logits(preprocess_images(images, processor, device))
+    elif OWL_CACHE_TEXT_QUERIES:
+        query_embeds, query_mask = encode_text_queries(model, processor, device)
+
+        pixel_values = preprocess_images(images, processor, device)
+
+        with torch.inference_mode():
+            logits = detect_with_cached_queries(
+                model,
+                pixel_values,
+                query_embeds,
+                query_mask
+            )
+    else:
+        inputs = processor(
+            text=[ALL_LABELS] * len(images),
+            return_tensors="pt"
         ).to(device)
+        inputs["pixel_values"] = preprocess_images(images, processor, device)
 
-        detections = processor.post_process_object_detection(
-            outputs,
-            target_sizes=target_sizes,
-            threshold=0.25
-        )[0]
+        with torch.inference_mode():
+            logits = model(**inputs).logits
 
-        for score, label_idx in zip(
-            detections["scores"],
-            detections["labels"]
-        ):
-            label = ALL_LABELS[label_idx]
-            score = float(score)
+    return category_results(category_max_scores(logits))
 
-            threshold = get_threshold(label)
-            if score < threshold:
-                continue
 
-            # -------- CATEGORY FLAGS --------
-            if label in ANIMAL_LABELS:
-                result["animal"] = True
+def detect_frames(frames, model, processor, device, batch_size=None):
+    """
+    Per-frame category flags for a list of PIL images / BGR arrays,
+    batch_size at a time
+    (used by video voting, which needs every frame's verdict).
+    """
+    batch_size = max(1, batch_size or OWL_BATCH_SIZE)
+    results = []
 
-            elif label in DAS_LABELS:
-                result["das"] = True
+    for start in range(0, len(frames), batch_size):
+        results.extend(
+            detect_batch(frames[start:start + batch_size], model, processor, device)
+        )
 
-            elif label in WEAPON_LABELS:
-                result["weapon"] = True
+    return results
 
-        # 🔥 EARLY EXIT — only when all found
-        if all(result.values()):
-            break
+
+# =====================================================
+# CORE MERGED DETECTOR
+# =====================================================
+def run_merged_detection(media, model, processor, device, batch_size=None):
+    """
+    media: PIL.Image / BGR array OR any iterable of them (list, generator, ...)
+    batch_size: frames per forward pass (default OWL_BATCH_SIZE)
+
+    Frames are pulled batch_size at a time as they arrive, so decoding
+    and inference interleave; on early exit a generator source is
+    closed, which stops its decoding too.
+    """
+
+    single = isinstance(media, (Image.Image, np.ndarray))
+    frames = iter([media]) if single else iter(media)
+    batch_size = max(1, batch_size or OWL_BATCH_SIZE)
+
+    result = empty_result()
+
+    try:
+        while True:
+            batch = list(islice(frames, batch_size))
+            if not batch:
+                break
+
+            for frame_result in detect_batch(batch, model, processor, device):
+                merge_results(result, frame_result)
+
+            # 🔥 EARLY EXIT — only when all found
+            if all_found(result):
+                break
+
+    finally:
+        close = getattr(frames, "close", None)
+        if close is not None:
+            close()
 
     return result
+
+
+# =====================================================
+# SHARED VIDEO DECODE CONSUMER
+# =====================================================
+class OwlFrameConsumer(FrameConsumer):
+    """
+    Buffers every `stride`-th frame into batches of batch_size and
+    stops once all categories have been found.
+    """
+
+    name = "owl"
+    decode_long_side = OWL_INPUT_SIDE
+
+    def __init__(self, model, processor, device, stride=20, batch_size=None, every_seconds=None, max_frames=None):
+        super().__init__(stride=stride, every_seconds=every_seconds, max_frames=max_frames)
+        self.model = model
+        self.processor = processor
+        self.device = device
+        self.batch_size = max(1, batch_size or OWL_BATCH_SIZE)
+        self.pending = []
+        self.merged = empty_result()
+
+    def feed(self, frame_idx, frame):
+        # decoder yields a fresh BGR array per frame: no conversion needed
+        self.pending.append(frame)
+
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+
+        result = run_merged_detection(
+            self.pending,
+            self.model,
+            self.processor,
+            self.device,
+            batch_size=self.batch_size
+        )
+        self.pending = []
+
+        merge_results(self.merged, result)
+
+        # 🔥 EARLY EXIT — only when all found
+        if all_found(self.merged):
+            self.done = True
+
+    def result(self):
+        if not self.done:
+            self.flush()
+        return self.merged
@@ -1,9 +1,27 @@
 # models.py
+import os
+
 import torch
 from transformers import Owlv2Processor, Owlv2ForObjectDetection
 
+from config import (
+    OWL_CACHE_TEXT_QUERIES,
+    OWL_BACKEND,
+    OWL_TORCH_THREADS,
+    OWL_TORCH_INTEROP_THREADS
+)
+from merged_owlvit_detector import encode_text_queries, check_fast_preprocess
+from owl_backends import load_onnx_backend, load_torch_backend
+
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 
+# explicit CPU thread counts (interop must be set before any parallel work)
+if OWL_TORCH_INTEROP_THREADS > 0:
+    torch.set_num_interop_threads(OWL_TORCH_INTEROP_THREADS)
+# (under worker_pool the per-process WORKER_THREADS cap wins)
+if OWL_TORCH_THREADS > 0 and not os.getenv("WORKER_POOL_THREADS"):
+    torch.set_num_threads(OWL_TORCH_THREADS)
+
 print("🚀 Loading OWL-V2 model once...")
 
 owl_processor = Owlv2Processor.from_pretrained(
@@ -17,4 +35,29 @@ owl_model = Owlv2ForObjectDetection.from_pretrained(
 # # optional but recommended
 # owl_model.half()
 
+# label queries never change → encode them once at startup
+if OWL_CACHE_TEXT_QUERIES:
+    encode_text_queries(owl_model, owl_processor, DEVICE)
+
+# OpenCV preprocessing must match the HF processor, else it is disabled
+check_fast_preprocess(owl_processor)
+
+# optional tuned PyTorch / ONNX Runtime serving: owl_model is then the
+# backend object (same detection API), plain PyTorch stays on any
+# export / warmup / parity failure
+backend = None
+
+if OWL_BACKEND == "torch-opt":
+    backend = load_torch_backend(owl_model, owl_processor, DEVICE)
+elif OWL_BACKEND in ("onnx", "onnx-int8"):
+    backend = load_onnx_backend(
+        owl_model,
+        owl_processor,
+        DEVICE,
+        quantize=OWL_BACKEND == "onnx-int8"
+    )
+
+if backend is not None:
+    owl_model = backend
+
 print(f"✅ OWL-V2 loaded on {DEVICE}")
@@ -1,13 +1,98 @@
 import os
 import cv2
 import uuid
-import tempfile
+import threading
+from functools import partial
+import numpy as np
+import nudenet
 from nudenet import NudeDetector
 
+from config import (
+    NSFW_BATCH_SIZE,
+    NSFW_FAST_RESOLUTION,
+    NSFW_FULL_MODEL_PATH,
+    NSFW_FULL_RESOLUTION,
+    NSFW_UNCERTAIN_LOW,
+    NSFW_UNCERTAIN_HIGH,
+    NSFW_SKIN_GATE,
+    NSFW_SKIN_GATE_MIN_RATIO,
+    NSFW_SKIN_GATE_MIN_SATURATION
+)
+from frame_source import FrameConsumer, decode_shared
+
 # ----------------------------
 # Init model once (IMPORTANT)
 # ----------------------------
-detector = NudeDetector()
+# the 320px model shipped inside the nudenet package (NudeDetector's
+# default), passed explicitly so set_session_threads can reopen it
+DEFAULT_MODEL_PATH = os.path.join(os.path.dirname(nudenet.__file__), "320n.onnx")
+
+detector = NudeDetector(model_path=DEFAULT_MODEL_PATH)
+
+# full resolution tier of the cascade (None = the default detector)
+full_detector = (
+    NudeDetector(
+        model_path=NSFW_FULL_MODEL_PATH,
+        inference_resolution=NSFW_FULL_RESOLUTION
+    )
+    if NSFW_FULL_MODEL_PATH else None
+)
+
+
+def _load_fast_detector():
+    """
+    Default model at NSFW_FAST_RESOLUTION, or None when not configured
+    or the model does not run at that resolution (fixed input shape).
+    """
+    if not NSFW_FAST_RESOLUTION:
+        return None
+
+    fast = NudeDetector(model_path=DEFAULT_MODEL_PATH, inference_resolution=NSFW_FAST_RESOLUTION)
+    try:
+        fast.detect(np.zeros((NSFW_FAST_RESOLUTION, NSFW_FAST_RESOLUTION, 3), dtype=np.uint8))
+    except Exception as e:
+        print(f"[NSFW][CASCADE] Fast tier unavailable at {NSFW_FAST_RESOLUTION}px, disabled:", e)
+        return None
+
+    print(f"[NSFW][CASCADE] Fast tier at {NSFW_FAST_RESOLUTION}px")
+    return fast
+
+
+# low resolution tier of the cascade (None = the default detector)
+fast_detector = _load_fast_detector()
+
+# cascade tiers: every image goes through first_tier, the uncertainty
+# band through escalation_tier (None = single tier)
+first_tier = fast_detector or detector
+escalation_tier = full_detector or (detector if fast_detector is not None else None)
+
+
+def set_session_threads(threads: int):
+    """
+    Rebuild the NudeNet ONNX Runtime sessions with `threads` intra-op
+    threads. NudeDetector always uses ORT defaults (one thread per
+    core); worker_pool calls this in every consumer process.
+    """
+    import onnxruntime as ort
+
+    for nude_detector, model_path in (
+        (detector, DEFAULT_MODEL_PATH),
+        (fast_detector, DEFAULT_MODEL_PATH),
+        (full_detector, NSFW_FULL_MODEL_PATH)
+    ):
+        if nude_detector is None:
+            continue
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+
+        nude_detector.onnx_session = ort.InferenceSession(
+            model_path,
+            sess_options=options,
+            providers=nude_detector.onnx_session.get_providers()
+        )
+
 
 # ----------------------------
 # NSFW policy
@@ -24,100 +109,393 @@ THRESHOLD = 0.5
 VIDEO_NSFW_FRAME_LIMIT = 3
 
 
+def has_hard_nsfw(detections) -> bool:
+    """
+    True if any NudeNet detection is a HARD_NSFW class above THRESHOLD
+    """
+    for d in detections:
+        if d.get("class") in HARD_NSFW and d.get("score", 0) >= THRESHOLD:
+            return True
+    return False
+
+
+def class_scores(detections) -> dict:
+    """
+    NudeNet detections → {class: highest score} for one image / frame
+    """
+    scores = {}
+    for d in detections:
+        label = d.get("class")
+        scores[label] = max(scores.get(label, 0.0), float(d.get("score", 0)))
+    return scores
+
+
+def is_hard_nsfw_scores(scores: dict) -> bool:
+    """
+    has_hard_nsfw for class_scores output
+    """
+    return hard_nsfw_score(scores) >= THRESHOLD
+
+
+def hard_nsfw_score(scores: dict) -> float:
+    """
+    Highest HARD_NSFW class score (0.0 if none detected)
+    """
+    return max((scores.get(label, 0.0) for label in HARD_NSFW), default=0.0)
+
+
+# ----------------------------
+# Skin gate (before NudeNet)
+# ----------------------------
+SKIN_GATE_SIDE = 160  # colour statistics need no more than this
+
+_gate_stats = {
+    "gated": 0,   # NudeNet skipped: too little skin
+    "passed": 0   # sent on to NudeNet
+}
+
+
+def skin_gate_stats() -> dict:
+    """
+    Snapshot of the skin gate counters since process start
+    """
+    with _cascade_lock:
+        return dict(_gate_stats)
+
+
+def skin_ratio(frame: np.ndarray, face_boxes=None):
+    """
+    Fraction of skin-coloured pixels in a BGR frame (YCrCb OR HSV skin
+    ranges, i.e. the permissive union), ignoring face_boxes
+    ([x1, y1, x2, y2] in frame pixels, as from face_detect).
+    None when the frame is near-grayscale: colour says nothing there.
+    """
+    h, w = frame.shape[:2]
+    scale = min(1.0, SKIN_GATE_SIDE / max(h, w))
+    small = cv2.resize(
+        frame,
+        (max(1, round(w * scale)), max(1, round(h * scale))),
+        interpolation=cv2.INTER_AREA
+    ) if scale < 1.0 else frame
+
+    hsv = cv2.cvtColor(small, cv2.COLOR_BGR2HSV)
+    if hsv[..., 1].mean() < NSFW_SKIN_GATE_MIN_SATURATION:
+        return None
+
+    ycrcb = cv2.cvtColor(small, cv2.COLOR_BGR2YCrCb)
+    skin = (
+        cv2.inRange(ycrcb, (0, 133, 77), (255, 173, 127))
+        | cv2.inRange(hsv, (0, 40, 60), (25, 255, 255))
+        | cv2.inRange(hsv, (165, 40, 60), (180, 255, 255))
+    )
+
+    for x1, y1, x2, y2 in face_boxes or []:
+        skin[
+            max(0, int(y1 * scale)):max(0, int(y2 * scale)),
+            max(0, int(x1 * scale)):max(0, int(x2 * scale))
+        ] = 0
+
+    return cv2.countNonZero(skin) / skin.size
+
+
+def passes_skin_gate(image, face_boxes=None) -> bool:
+    """
+    False only when the image cannot plausibly show exposed skin.
+    Anything that is not a 3-channel array passes untouched.
+
+    face_boxes: face boxes to leave out, or a callable returning them.
+    Faces can only lower the ratio, so they are looked up only for
+    images that would pass with them.
+    """
+    if not NSFW_SKIN_GATE:
+        return True
+
+    if isinstance(image, np.ndarray) and image.ndim == 3 and image.shape[2] == 3:
+        ratio = skin_ratio(image)
+
+        if ratio is not None and ratio >= NSFW_SKIN_GATE_MIN_RATIO and face_boxes:
+            try:
+                boxes = face_boxes() if callable(face_boxes) else face_boxes
+            except Exception as e:
+                print("[NSFW][SKIN GATE] Face lookup failed:", e)
+                boxes = None
+            if boxes:
+                ratio = skin_ratio(image, boxes)
+
+        passed = ratio is None or ratio >= NSFW_SKIN_GATE_MIN_RATIO
+    else:
+        passed = True
+
+    with _cascade_lock:
+        _gate_stats["passed" if passed else "gated"] += 1
+
+    return passed
+
+
+# ----------------------------
+# Low-res / full-res cascade
+# ----------------------------
+_cascade_lock = threading.Lock()
+_cascade_stats = {
+    "scored": 0,      # images / frames through the first tier
+    "cleared": 0,     # first tier verdict final, not NSFW
+    "flagged": 0,     # first tier verdict final, NSFW
+    "escalated": 0,   # inside the band → escalation tier
+    "escalated_nsfw": 0
+}
+
+
+def cascade_stats() -> dict:
+    """
+    Snapshot of the cascade counters since process start
+    """
+    with _cascade_lock:
+        return dict(_cascade_stats)
+
+
+def _detect_all(nude_detector, images: list, batch_size: int) -> list:
+    """
+    detections per image (paths or BGR arrays), batch_size per session run;
+    one run per image if the batched run fails (e.g. a fixed batch
+    dimension in the ONNX export)
+    """
+    if len(images) > 1:
+        try:
+            return nude_detector.detect_batch(images, batch_size=batch_size)
+        except Exception as e:
+            print("[NSFW] Batch detection error, scoring one by one:", e)
+
+    detections = []
+    for image in images:
+        try:
+            detections.append(nude_detector.detect(image))
+        except Exception as e:
+            print("[NSFW] Detection error:", e)
+            detections.append([])
+    return detections
+
+
+def cascade_scores(images: list, batch_size: int = None, face_boxes: list = None) -> list:
+    """
+    class_scores per image. With NSFW_SKIN_GATE, images failing the skin
+    gate get {} without any NudeNet run (face_boxes: optional list of
+    per-image face boxes, see passes_skin_gate). First tier for everything
+    else; with an escalation tier configured, images whose hard score
+    falls in the uncertainty band are re-scored by it (their scores
+    replace the first tier ones).
+    """
+    if not images:
+        return []
+
+    if not NSFW_SKIN_GATE:
+        return _tiered_scores(images, batch_size)
+
+    face_boxes = face_boxes or [None] * len(images)
+    kept = [
+        i for i, image in enumerate(images)
+        if passes_skin_gate(image, face_boxes[i])
+    ]
+
+    scores = [{} for _ in images]
+    for i, frame_scores in zip(kept, _tiered_scores([images[i] for i in kept], batch_size)):
+        scores[i] = frame_scores
+
+    return scores
+
+
+def _tiered_scores(images: list, batch_size: int = None) -> list:
+    """
+    cascade_scores after the skin gate: first tier, then escalation
+    """
+    if not images:
+        return []
+
+    batch_size = max(1, batch_size or NSFW_BATCH_SIZE)
+    scores = [class_scores(d) for d in _detect_all(first_tier, images, batch_size)]
+
+    if escalation_tier is None:
+        return scores
+
+    uncertain = [
+        i for i, frame_scores in enumerate(scores)
+        if NSFW_UNCERTAIN_LOW <= hard_nsfw_score(frame_scores) < NSFW_UNCERTAIN_HIGH
+    ]
+
+    if uncertain:
+        escalated_scores = [
+            class_scores(d)
+            for d in _detect_all(escalation_tier, [images[i] for i in uncertain], batch_size)
+        ]
+        for i, frame_scores in zip(uncertain, escalated_scores):
+            scores[i] = frame_scores
+
+    # counted on the final verdicts (THRESHOLD), not the band edges
+    escalated = set(uncertain)
+    nsfw = [is_hard_nsfw_scores(frame_scores) for frame_scores in scores]
+
+    with _cascade_lock:
+        _cascade_stats["scored"] += len(images)
+        _cascade_stats["escalated"] += len(escalated)
+        _cascade_stats["escalated_nsfw"] += sum(nsfw[i] for i in escalated)
+        _cascade_stats["flagged"] += sum(
+            hit for i, hit in enumerate(nsfw) if i not in escalated
+        )
+        _cascade_stats["cleared"] += sum(
+            not hit for i, hit in enumerate(nsfw) if i not in escalated
+        )
+
+    return scores
+
+
 # ----------------------------
 # Image NSFW detection
 # ----------------------------
-def image_nsfw(image_path: str) -> bool:
+def image_nsfw(image, face_boxes=None) -> bool:
     """
     Returns True if image is NSFW
+    image: file path OR decoded BGR ndarray (fed to NudeNet from memory)
+    face_boxes: optional face boxes for the skin gate
     """
-    try:
-        detections = detector.detect(image_path)
-        print("[NSFW][IMAGE] Detections:", detections)
-    except Exception as e:
-        print("[NSFW][IMAGE] Detection failed:", e)
-        return False
+    if NSFW_SKIN_GATE and isinstance(image, str):
+        # decode once: the gate and NudeNet share the array
+        decoded = cv2.imread(image)
+        if decoded is not None:
+            image = decoded
 
-    for d in detections:
-        if d.get("class") in HARD_NSFW and d.get("score", 0) >= THRESHOLD:
-            print("[NSFW][IMAGE] HARD NSFW detected")
-            return True
+    scores = cascade_scores([image], face_boxes=[face_boxes])[0]
+    print("[NSFW][IMAGE] Class scores:", scores)
+
+    if is_hard_nsfw_scores(scores):
+        print("[NSFW][IMAGE] HARD NSFW detected")
+        return True
 
     return False
 
 
+# ----------------------------
+# Frame NSFW detection (in memory)
+# ----------------------------
+def frame_nsfw(frame: np.ndarray) -> bool:
+    """
+    Returns True if a decoded BGR frame is NSFW.
+    The array goes straight to NudeNet: no temp JPEG, no re-encode.
+    """
+    return is_hard_nsfw_scores(cascade_scores([frame])[0])
+
+
+def score_frames(frames: list, batch_size: int = None, face_boxes: list = None) -> list:
+    """
+    Batched NudeNet over BGR frames: batch_size frames per session run
+    (default NSFW_BATCH_SIZE), through the cascade when configured.
+    Returns one class_scores dict per frame.
+    """
+    return cascade_scores(frames, batch_size, face_boxes)
+
+
+def frames_nsfw(frames: list, batch_size: int = None) -> list:
+    """
+    Batched variant of frame_nsfw. Returns one bool per frame.
+    """
+    return [is_hard_nsfw_scores(scores) for scores in score_frames(frames, batch_size)]
+
+
 # ----------------------------
 # Video NSFW detection
 # ----------------------------
-def video_nsfw(video_path: str, skip_frames: int = 10) -> bool:
+class NsfwVideoConsumer(FrameConsumer):
     """
-    Returns True if video is NSFW.
     If VIDEO_NSFW_FRAME_LIMIT frames contain NSFW → True
+
+    Sampled frames are scored batch_size at a time (score_frames) and
+    counted in frame order, so the verdict matches the per-frame loop;
+    decoding stops at the batch that reaches the limit.
+    frame_scores keeps (frame_idx, class_scores) for every scored frame.
+
+    face_boxes: optional callable (frame_idx, frame) → face boxes for
+    the skin gate (MinorVideoConsumer.face_boxes).
     """
-    cap = cv2.VideoCapture(video_path)
 
-    if not cap.isOpened():
-        print("[NSFW][VIDEO] Failed to open video:", video_path)
-        return False
+    name = "nsfw"
+    # NudeNet pads to square and resizes to its inference resolution
+    # (the escalation tier's when the cascade may escalate)
+    decode_long_side = getattr(escalation_tier or first_tier, "input_width", 320)
 
-    frame_count = 0
-    nsfw_frames = 0
+    def __init__(self, skip_frames: int = 10, every_seconds: float = None, batch_size: int = None, face_boxes=None):
+        # every (skip_frames + 1)th frame, starting with the first one
+        super().__init__(
+            stride=skip_frames + 1 if skip_frames > 0 else 1,
+            every_seconds=every_seconds
+        )
+        self.batch_size = max(1, batch_size or NSFW_BATCH_SIZE)
+        self.face_boxes = face_boxes
+        self.pending = []
+        self.frame_scores = []
+        self.nsfw_frames = 0
 
-    try:
-        while True:
-            ret, frame = cap.read()
-            if not ret:
-                break
+    def feed(self, frame_idx, frame):
+        self.pending.append((frame_idx, frame))
 
-            frame_count += 1
+        if len(self.pending) >= self.batch_size:
+            self.flush()
 
-            # Skip logic (optional, currently disabled)
-            if skip_frames > 0 and frame_count % (skip_frames + 1) != 1:
-                continue
+    def flush(self):
+        if not self.pending:
+            return
 
-            # Create a unique temp file per frame (SAFE)
-            with tempfile.NamedTemporaryFile(
-                suffix=".jpg",
-                delete=False
-            ) as tmp:
-                temp_path = tmp.name
+        indices = [frame_idx for frame_idx, _ in self.pending]
+        face_boxes = [
+            partial(self.face_boxes, frame_idx, frame)
+            for frame_idx, frame in self.pending
+        ] if self.face_boxes is not None else None
 
-            cv2.imwrite(temp_path, frame)
+        scores = score_frames([frame for _, frame in self.pending], self.batch_size, face_boxes)
+        self.pending = []
 
-            try:
-                detections = detector.detect(temp_path)
-            except Exception as e:
-                print("[NSFW][VIDEO] Detection error:", e)
-                detections = []
-            finally:
-                if os.path.exists(temp_path):
-                    os.remove(temp_path)
-
-            for d in detections:
-                if d.get("class") in HARD_NSFW and d.get("score", 0) >= THRESHOLD:
-                    nsfw_frames += 1
-                    print(
-                        f"[NSFW][VIDEO] NSFW frame detected "
-                        f"({nsfw_frames}/{VIDEO_NSFW_FRAME_LIMIT})"
-                    )
-                    break
-
-            if nsfw_frames >= VIDEO_NSFW_FRAME_LIMIT:
+        for frame_idx, frame_scores in zip(indices, scores):
+            self.frame_scores.append((frame_idx, frame_scores))
+
+            if not is_hard_nsfw_scores(frame_scores):
+                continue
+
+            self.nsfw_frames += 1
+            print(
+                f"[NSFW][VIDEO] NSFW frame detected "
+                f"({self.nsfw_frames}/{VIDEO_NSFW_FRAME_LIMIT})"
+            )
+
+            if self.nsfw_frames >= VIDEO_NSFW_FRAME_LIMIT:
                 print("[NSFW][VIDEO] HARD NSFW video detected")
-                return True
+                self.done = True
+                return
 
-    finally:
-        cap.release()
+    def result(self):
+        if not self.done:
+            self.flush()
 
-    return False
+        if escalation_tier is not None:
+            print("[NSFW][CASCADE] Totals:", cascade_stats())
+        if NSFW_SKIN_GATE:
+            print("[NSFW][SKIN GATE] Totals:", skin_gate_stats())
+
+        return self.nsfw_frames >= VIDEO_NSFW_FRAME_LIMIT
+
+
+def video_nsfw(video_path: str, skip_frames: int = 10) -> bool:
+    """
+    Returns True if video is NSFW.
+    If VIDEO_NSFW_FRAME_LIMIT frames contain NSFW → True
+    """
+    consumer = NsfwVideoConsumer(skip_frames)
+    return bool(decode_shared(video_path, [consumer])["nsfw"])
 
 
 # ----------------------------
 # Unified NSFW entry function
 # ----------------------------
-def is_nsfw(path: str) -> bool:
+def is_nsfw(path: str, face_boxes=None) -> bool:
     """
     Detect NSFW for image or video
+    face_boxes: optional face boxes of the image, for the skin gate
     """
     if not os.path.exists(path):
         raise FileNotFoundError(path)
@@ -130,7 +508,7 @@ def is_nsfw(path: str) -> bool:
     print(f"[NSFW] Checking file: {path}")
 
     if ext in image_exts:
-        return image_nsfw(path)
+        return image_nsfw(path, face_boxes)
 
     if ext in video_exts:
         return video_nsfw(path)
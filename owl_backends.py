@@ -0,0 +1,364 @@
+import hashlib
+import os
+from pathlib import Path
+
+import numpy as np
+import torch
+from PIL import Image
+
+from config import (
+    OWL_BATCH_SIZE,
+    OWL_ONNX_DIR,
+    OWL_ONNX_THREADS,
+    OWL_PARITY_IMAGE_DIR,
+    OWL_BACKEND_TOLERANCE,
+    OWL_TORCH_BF16,
+    OWL_TORCH_COMPILE,
+    OWL_TORCH_CHANNELS_LAST,
+    OWL_TORCH_WARMUP
+)
+from merged_owlvit_detector import (
+    ALL_LABELS,
+    category_max_scores,
+    detect_with_cached_queries,
+    encode_text_queries,
+    preprocess_images,
+    synthetic_image
+)
+
+# Every backend here exposes class_logits(pixel_values) → logits
+# [B, boxes, Q] against the fixed label queries; detect_batch (and so
+# run_merged_detection) uses it in place of the PyTorch model.
+
+PARITY_IMAGE_LIMIT = 8
+
+
+# =====================================================
+# FIXED PARITY IMAGE SET
+# =====================================================
+def parity_images():
+    """
+    Images from OWL_PARITY_IMAGE_DIR (sorted, at most PARITY_IMAGE_LIMIT),
+    else a fixed set of synthetic images of typical upload shapes.
+    """
+    if OWL_PARITY_IMAGE_DIR and os.path.isdir(OWL_PARITY_IMAGE_DIR):
+        paths = sorted(
+            path for path in Path(OWL_PARITY_IMAGE_DIR).iterdir()
+            if path.suffix.lower() in {".jpg", ".jpeg", ".png", ".bmp", ".webp"}
+        )[:PARITY_IMAGE_LIMIT]
+
+        if paths:
+            return [Image.open(path).convert("RGB") for path in paths]
+
+    return [
+        synthetic_image(width, height, seed)
+        for seed, (width, height) in enumerate([
+            (960, 960), (1280, 720), (720, 1280), (640, 480)
+        ])
+    ]
+
+
+def check_backend_parity(backend, model, processor, device, tolerance=None):
+    """
+    Run the PyTorch model and backend on parity_images(). Passes when the
+    per-query max probabilities stay within tolerance and every category
+    verdict agrees.
+    """
+    tolerance = OWL_BACKEND_TOLERANCE if tolerance is None else tolerance
+    query_embeds, query_mask = encode_text_queries(model, processor, device)
+
+    worst = 0.0
+    verdicts_match = True
+
+    for image in parity_images():
+        pixel_values = preprocess_images([image], processor, device)
+
+        with torch.no_grad():
+            expected = detect_with_cached_queries(
+                model,
+                pixel_values,
+                query_embeds,
+                query_mask
+            ).float().cpu()
+
+        actual = backend.class_logits(pixel_values).float().cpu()
+
+        worst = max(
+            worst,
+            (torch.sigmoid(expected).amax(1) - torch.sigmoid(actual).amax(1)).abs().max().item()
+        )
+        verdicts_match = verdicts_match and torch.equal(
+            category_max_scores(expected) > 0,
+            category_max_scores(actual) > 0
+        )
+
+    print(
+        f"[OWL] {backend.name} parity: max |Δp|={worst:.4f} "
+        f"(tolerance {tolerance}), verdicts match={verdicts_match}"
+    )
+
+    return worst <= tolerance and verdicts_match
+
+
+# =====================================================
+# LOGITS GRAPH (QUERIES BAKED IN)
+# =====================================================
+class OwlLogitsModule(torch.nn.Module):
+    """
+    Vision tower + class head with the label queries as constants:
+    pixel_values [B, 3, S, S] → logits [B, boxes, Q]. This is the graph
+    exported to ONNX.
+    """
+
+    def __init__(self, model, query_embeds, query_mask):
+        super().__init__()
+        self.model = model
+        self.register_buffer("query_embeds", query_embeds)
+        self.register_buffer("query_mask", query_mask)
+
+    def forward(self, pixel_values):
+        return detect_with_cached_queries(
+            self.model,
+            pixel_values,
+            self.query_embeds,
+            self.query_mask
+        )
+
+
+# =====================================================
+# TUNED PYTORCH CPU BACKEND
+# =====================================================
+def cpu_supports_bf16() -> bool:
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except (AttributeError, RuntimeError):
+        return False
+
+
+class OwlTorchBackend:
+    """
+    Same model, tuned for CPU serving: inference_mode, optional bf16
+    autocast, channels_last, and torch.compile at a fixed input shape.
+
+    Batches are padded to one of two compiled shapes (1 for still images,
+    batch_size for video) so nothing recompiles after warmup.
+    """
+
+    def __init__(
+        self,
+        model,
+        processor,
+        device,
+        batch_size=None,
+        bf16=OWL_TORCH_BF16,
+        compile=OWL_TORCH_COMPILE,
+        channels_last=OWL_TORCH_CHANNELS_LAST
+    ):
+        query_embeds, query_mask = encode_text_queries(model, processor, device)
+
+        self.device = torch.device(device)
+        self.side = processor.image_processor.size["height"]
+        self.batch_size = max(1, batch_size or OWL_BATCH_SIZE)
+        self.bf16 = cpu_supports_bf16() if bf16 == "auto" else bf16 == "1"
+        self.channels_last = channels_last
+
+        self.module = OwlLogitsModule(model, query_embeds, query_mask).eval()
+        if channels_last:
+            self.module = self.module.to(memory_format=torch.channels_last)
+
+        self.forward = (
+            torch.compile(self.module, dynamic=False)
+            if compile else self.module
+        )
+
+        features = [
+            name for name, enabled in (
+                ("bf16", self.bf16),
+                ("compile", compile),
+                ("channels_last", channels_last)
+            ) if enabled
+        ]
+        self.name = "torch-opt:" + ("+".join(features) or "inference_mode")
+
+    def _run(self, chunk):
+        count = chunk.shape[0]
+        shape = 1 if count == 1 else self.batch_size
+
+        if count < shape:
+            chunk = torch.cat([chunk, chunk.new_zeros((shape - count, *chunk.shape[1:]))])
+
+        if self.channels_last:
+            chunk = chunk.contiguous(memory_format=torch.channels_last)
+
+        with torch.inference_mode(), torch.autocast(
+            self.device.type,
+            dtype=torch.bfloat16,
+            enabled=self.bf16
+        ):
+            logits = self.forward(chunk)
+
+        return logits[:count].float()
+
+    def class_logits(self, pixel_values):
+        pixel_values = pixel_values.to(self.device)
+
+        return torch.cat([
+            self._run(pixel_values[start:start + self.batch_size])
+            for start in range(0, pixel_values.shape[0], self.batch_size)
+        ])
+
+    def warmup(self, runs=OWL_TORCH_WARMUP):
+        """
+        Compile / autotune both batch shapes before the first job.
+        """
+        for shape in sorted({1, self.batch_size}):
+            dummy = torch.zeros((shape, 3, self.side, self.side), device=self.device)
+            for _ in range(runs):
+                self.class_logits(dummy)
+
+
+def load_torch_backend(model, processor, device):
+    """
+    Build, warm up and parity-check the tuned PyTorch backend.
+    Returns the backend, or None to keep serving with plain PyTorch.
+    """
+    try:
+        backend = OwlTorchBackend(model, processor, device)
+
+        print(f"[OWL] Warming up {backend.name}")
+        backend.warmup()
+    except Exception as e:
+        print(f"[OWL] ⚠️ Tuned PyTorch backend unavailable ({e}), using plain PyTorch")
+        return None
+
+    if not check_backend_parity(backend, model, processor, device):
+        print("[OWL] ⚠️ Tuned PyTorch backend failed parity check, using plain PyTorch")
+        return None
+
+    return backend
+
+
+# =====================================================
+# ONNX RUNTIME BACKEND
+# =====================================================
+def onnx_model_paths(onnx_dir=OWL_ONNX_DIR):
+    """
+    (fp32 path, int8 path); the label set is part of the name because the
+    query embeddings are baked into the graph.
+    """
+    labels_hash = hashlib.sha1("|".join(ALL_LABELS).encode()).hexdigest()[:8]
+    base = Path(onnx_dir) / f"owlv2_logits_{labels_hash}"
+    return base.with_suffix(".onnx"), base.with_suffix(".int8.onnx")
+
+
+def temp_model_path(path: Path) -> Path:
+    """
+    Per-process sibling of path to write into before os.replace, so a
+    concurrent worker never loads a half-written model.
+    """
+    return path.with_name(f"{path.stem}.{os.getpid()}.tmp{path.suffix}")
+
+
+def export_owl_onnx(model, processor, device, quantize=False, onnx_dir=OWL_ONNX_DIR):
+    """
+    Export the logits graph once (and its dynamic int8 variant when
+    quantize=True). Existing files are reused. Returns the path to serve.
+    """
+    fp32_path, int8_path = onnx_model_paths(onnx_dir)
+    fp32_path.parent.mkdir(parents=True, exist_ok=True)
+
+    if not fp32_path.exists():
+        print(f"[OWL] Exporting ONNX graph → {fp32_path}")
+
+        query_embeds, query_mask = encode_text_queries(model, processor, device)
+        module = OwlLogitsModule(model, query_embeds, query_mask).eval()
+        side = processor.image_processor.size["height"]
+        tmp_path = temp_model_path(fp32_path)
+
+        with torch.no_grad():
+            torch.onnx.export(
+                module,
+                (torch.zeros((1, 3, side, side), device=device),),
+                str(tmp_path),
+                input_names=["pixel_values"],
+                output_names=["logits"],
+                dynamic_axes={
+                    "pixel_values": {0: "batch"},
+                    "logits": {0: "batch"}
+                },
+                opset_version=17,
+                dynamo=False
+            )
+
+        os.replace(tmp_path, fp32_path)
+
+    if not quantize:
+        return fp32_path
+
+    if not int8_path.exists():
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        print(f"[OWL] Quantizing ONNX graph (dynamic int8) → {int8_path}")
+        tmp_path = temp_model_path(int8_path)
+        quantize_dynamic(
+            str(fp32_path),
+            str(tmp_path),
+            weight_type=QuantType.QInt8
+        )
+        os.replace(tmp_path, int8_path)
+
+    return int8_path
+
+
+class OwlOnnxBackend:
+    """
+    ONNX Runtime (CPU) session over the exported logits graph.
+    """
+
+    def __init__(self, path, threads=OWL_ONNX_THREADS):
+        self.path = path
+        self.name = f"onnx:{Path(path).name}"
+        self.set_threads(threads)
+
+    def set_threads(self, threads):
+        """
+        (Re)build the session with `threads` intra-op threads (0 = ORT default)
+        """
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads > 0:
+            options.intra_op_num_threads = threads
+
+        self.session = ort.InferenceSession(
+            str(self.path),
+            sess_options=options,
+            providers=["CPUExecutionProvider"]
+        )
+
+    def class_logits(self, pixel_values):
+        logits = self.session.run(
+            ["logits"],
+            {"pixel_values": np.ascontiguousarray(pixel_values.cpu().numpy(), dtype=np.float32)}
+        )[0]
+        return torch.from_numpy(logits)
+
+
+def load_onnx_backend(model, processor, device, quantize=False):
+    """
+    Export (if needed), load and parity-check the ONNX backend.
+    Returns the backend, or None to keep serving with PyTorch.
+    """
+    try:
+        path = export_owl_onnx(model, processor, device, quantize=quantize)
+        backend = OwlOnnxBackend(path)
+    except Exception as e:
+        print(f"[OWL] ⚠️ ONNX backend unavailable ({e}), using PyTorch")
+        return None
+
+    if not check_backend_parity(backend, model, processor, device):
+        print("[OWL] ⚠️ ONNX backend failed parity check, using PyTorch")
+        return None
+
+    return backend
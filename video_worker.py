@@ -2,20 +2,23 @@ import os
 import cv2
 import redis
 import time
-import json
 from pathlib import Path
-from PIL import Image
 
 from model import owl_model, owl_processor, DEVICE
-from merged_owlvit_detector import run_merged_detection
+from merged_owlvit_detector import detect_frames, empty_result, OWL_INPUT_SIDE
 
-from face_detect.minor_detect import is_minor
+from face_detect.minor_detect import is_minor, minor_image_check
 from meetup_detect.personal_details_detect import detect_personal_info
-from violance_detect.violation_detect import is_violence_detected
+from violance_detect.violation_detect import is_violence_detected, load_violence_model
 from nsfw.nsfw_detector import is_nsfw
+from frame_source import FrameConsumer, decode_shared
+from worker_common import run_shared_video_checks, handle_message
 
 from dynamic_update import dynamic_update
-from config import REDIS_HOST, REDIS_PORT, REDIS_DB, INPUT_QUEUE, REDIS_BRPOP_TIMEOUT
+from config import (
+    REDIS_HOST, REDIS_PORT, REDIS_DB, INPUT_QUEUE, REDIS_BRPOP_TIMEOUT, OWL_BATCH_SIZE,
+    KEYFRAME_SAMPLE_SECONDS
+)
 
 
 # =====================================================
@@ -82,53 +85,78 @@ VIDEO_EXT = {".mp4", ".avi", ".mov", ".mkv"}
 # =====================================================
 # KEYFRAME EXTRACTION
 # =====================================================
-def extract_candidate_frames(
-    video_path: str,
-    max_frames: int = 12,
-    scene_threshold: float = 25.0
-):
-    print(f"[VIDEO] Opening video for keyframe extraction: {video_path}")
-    cap = cv2.VideoCapture(video_path)
-
-    prev_gray = None
-    candidates = []
-    frame_idx = 0
-
-    while cap.isOpened():
-        ret, frame = cap.read()
-        if not ret:
-            break
-
-        frame_idx += 1
+class KeyframeConsumer(FrameConsumer):
+    """
+    Collects scene-change frames (mean abs diff vs previous sampled
+    frame). Consecutive frames are compared unless every_seconds is set;
+    then one frame per every_seconds is, and the decode only grab()s the
+    frames in between.
+    """
+
+    name = "keyframes"
+    decode_long_side = OWL_INPUT_SIDE  # candidates go to OWL-V2
+
+    def __init__(self, max_candidates: int = 12, scene_threshold: float = 25.0, every_seconds: float = KEYFRAME_SAMPLE_SECONDS):
+        # max_candidates caps the keyframes kept, not the frames sampled
+        # (FrameConsumer.max_frames stays None: every interval is compared)
+        super().__init__(stride=1, every_seconds=every_seconds or None)
+        self.max_candidates = max_candidates
+        self.scene_threshold = scene_threshold
+        self.prev_gray = None
+        self.first_frame = None
+        self.candidates = []
+
+    def feed(self, frame_idx, frame):
         gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
 
-        if prev_gray is not None:
-            diff = cv2.absdiff(gray, prev_gray)
+        if self.first_frame is None:
+            self.first_frame = frame
+
+        if self.prev_gray is not None:
+            diff = cv2.absdiff(gray, self.prev_gray)
             score = diff.mean()
 
-            if score > scene_threshold:
-                print(f"[KEYFRAME] Scene change at frame {frame_idx} (score={score:.2f})")
-                candidates.append(frame)
+            if score > self.scene_threshold:
+                print(f"[KEYFRAME] Scene change at frame {frame_idx + 1} (score={score:.2f})")
+                self.candidates.append(frame)
 
-        prev_gray = gray
+        self.prev_gray = gray
 
-        if len(candidates) >= max_frames:
+        if len(self.candidates) >= self.max_candidates:
             print("[KEYFRAME] Reached max candidate frames")
-            break
+            self.done = True
+
+    def result(self):
+        candidates = self.candidates
+
+        # fallback
+        if not candidates and self.first_frame is not None:
+            print("[KEYFRAME] No scene changes detected, using fallback frame")
+            candidates = [self.first_frame]
 
-    cap.release()
+        print(f"[KEYFRAME] Selected {len(candidates)} candidate frames")
+        return candidates[:self.max_candidates]
 
-    # fallback
-    if not candidates:
-        print("[KEYFRAME] No scene changes detected, using fallback frame")
-        cap = cv2.VideoCapture(video_path)
-        ret, frame = cap.read()
-        if ret:
-            candidates.append(frame)
-        cap.release()
 
-    print(f"[KEYFRAME] Selected {len(candidates)} candidate frames")
-    return candidates[:max_frames]
+class OwlVotingConsumer(KeyframeConsumer):
+    """
+    Keyframes + OWL voting as a single shared-decode consumer.
+    """
+
+    name = "owl"
+
+    def result(self):
+        return vote_on_frames(super().result())
+
+
+def extract_candidate_frames(
+    video_path: str,
+    max_frames: int = 12,
+    scene_threshold: float = 25.0
+):
+    print(f"[VIDEO] Opening video for keyframe extraction: {video_path}")
+    consumer = KeyframeConsumer(max_frames, scene_threshold)
+    return decode_shared(video_path, [consumer])["keyframes"] or []
 
 
 
@@ -142,7 +170,14 @@ def run_video_with_voting(
 ):
     print("[VIDEO] Starting video moderation pipeline")
     frames = extract_candidate_frames(video_path)
+    return vote_on_frames(frames, min_hits, min_ratio)
 
+
+def vote_on_frames(
+    frames: list,
+    min_hits: int = 3,
+    min_ratio: float = 0.667  # 66.7%
+):
     total_frames = len(frames)
     print(f"[VIDEO] Total frames checked: {total_frames}")
 
@@ -153,21 +188,18 @@ def run_video_with_voting(
         "weapon": 0
     }
 
-    for idx, frame in enumerate(frames):
-        print(f"[OWL] Running OWL on frame {idx + 1}/{total_frames}")
-
-        image = Image.fromarray(
-            cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        )
-
-        result = run_merged_detection(
-            image,
-            owl_model,
-            owl_processor,
-            DEVICE
-        )
+    # BGR frames go straight into the OWL preprocessing
+    print(f"[OWL] Running OWL on {total_frames} frames (batch size {OWL_BATCH_SIZE})")
+    results = detect_frames(
+        frames,
+        owl_model,
+        owl_processor,
+        DEVICE,
+        batch_size=OWL_BATCH_SIZE
+    )
 
-        print("[DEBUG] OWL raw result:", result)
+    for idx, result in enumerate(results):
+        print(f"[DEBUG] OWL raw result frame {idx + 1}/{total_frames}:", result)
 
         for label in label_hits:
             if result.get(label):
@@ -194,6 +226,7 @@ def run_video_with_voting(
     print("[VIDEO] OWL voting completed")
     return label_final
 
+
 # =====================================================
 # PROCESS REDIS MESSAGE
 # =====================================================
@@ -217,6 +250,16 @@ def process_redis(payload: dict):
     ext = Path(file_path).suffix.lower()
     print("[FILE]", file_path)
 
+    # Videos are decoded once up front; other files go through each detector
+    shared = None
+    if ext in VIDEO_EXT:
+        shared = run_shared_video_checks(file_path, OwlVotingConsumer())
+
+    def check(name, detect, *args):
+        if shared is not None:
+            return shared[name]
+        return detect(file_path, *args)
+
     # -----------------------------
     # FLAGS
     # -----------------------------
@@ -227,19 +270,23 @@ def process_redis(payload: dict):
     personal_info_detected = False
     violence_detected = False
     nsfw_detected = None   # lazy
+    face_boxes = None      # image faces, left out by the NSFW skin gate
 
     # =====================================================
     # 1️⃣ MINOR
     # =====================================================
     try:
-        minor_detected = is_minor(file_path)
+        if ext in IMAGE_EXT:
+            minor_detected, face_boxes = minor_image_check(file_path)
+        else:
+            minor_detected = check("minor", is_minor)
         print("[CHECK] Minor:", minor_detected)
     except Exception as e:
         print("[ERROR] Minor:", e)
 
     if minor_detected:
         if nsfw_detected is None:
-            nsfw_detected = is_nsfw(file_path)
+            nsfw_detected = check("nsfw", is_nsfw, face_boxes)
             print("[CHECK] NSFW (minor):", nsfw_detected)
 
         if nsfw_detected:
@@ -263,7 +310,7 @@ def process_redis(payload: dict):
     # 2️⃣ PII
     # =====================================================
     try:
-        personal_info_detected = detect_personal_info(file_path)
+        personal_info_detected = check("personal_info", detect_personal_info)
         print("[CHECK] PII:", personal_info_detected)
     except Exception as e:
         print("[ERROR] PII:", e)
@@ -287,7 +334,7 @@ def process_redis(payload: dict):
     # 3️⃣ OWL (VIDEO)
     # =====================================================
     if ext in VIDEO_EXT:
-        merged = run_video_with_voting(file_path)
+        merged = shared["owl"] or empty_result()
     else:
         print("[SKIP] Unsupported type")
         return
@@ -308,7 +355,7 @@ def process_redis(payload: dict):
     # =====================================================
     if animal_detected:
         if nsfw_detected is None:
-            nsfw_detected = is_nsfw(file_path)
+            nsfw_detected = check("nsfw", is_nsfw, face_boxes)
             print("[CHECK] NSFW (animal):", nsfw_detected)
 
         if nsfw_detected:
@@ -336,7 +383,7 @@ def process_redis(payload: dict):
     # 4️⃣ VIOLENCE
     # =====================================================
     try:
-        violence_detected = is_violence_detected(file_path)
+        violence_detected = check("violence", is_violence_detected)
         print("[CHECK] Violence:", violence_detected)
     except Exception as e:
         print("[ERROR] Violence:", e)
@@ -348,7 +395,7 @@ def process_redis(payload: dict):
     if nsfw_detected is None:
         try:
             print("🔍 Final NSFW check...")
-            nsfw_detected = is_nsfw(file_path)
+            nsfw_detected = check("nsfw", is_nsfw, face_boxes)
         except Exception as e:
             print("NSFW error:", e)   
 
@@ -384,6 +431,8 @@ def process_redis(payload: dict):
 # WORKER LOOP
 # =====================================================
 def worker():
+    load_violence_model()
+
     print("🚀 Media Moderation Worker started")
     print("📥 Listening on:", INPUT_QUEUE)
 
@@ -396,13 +445,7 @@ def worker():
 
             _, message = item
 
-            try:
-                payload = json.loads(message)
-            except json.JSONDecodeError:
-                print("⚠️ Invalid JSON")
-                continue
-
-            process_redis(payload)
+            handle_message(message, process_redis)
 
         except Exception as e:
             print("❌ Worker error:", e)
@@ -1,9 +1,22 @@
 import os
 import cv2
 import numpy as np
+import tensorflow as tf
 from collections import deque
+from tensorflow.keras import Input, Sequential
+from tensorflow.keras.layers import Dropout, InputLayer, TimeDistributed
 from tensorflow.keras.models import load_model
 
+from config import (
+    VIOLENCE_ENCODE_BATCH_SIZE,
+    VIOLENCE_HEAD_BATCH_SIZE,
+    VIOLENCE_BACKEND,
+    VIOLENCE_TFLITE_DIR,
+    VIOLENCE_TFLITE_THREADS,
+    VIOLENCE_BACKEND_TOLERANCE
+)
+from frame_source import FrameConsumer, decode_shared
+
 # -----------------------------
 # Configuration
 # -----------------------------
@@ -17,79 +30,388 @@ CLASSES_LIST = ["NonViolence", "Violence"]
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 MODEL_PATH = os.path.join(BASE_DIR, "model", "MobBiLSTM_model_saved101.keras")
 
-print(f"🧠 Loading violence detection model from: {MODEL_PATH}")
-MoBiLSTM_model = load_model(MODEL_PATH)
+# loaded on first use (load_violence_model): TensorFlow is not fork-safe
+# once it has run, and worker_pool imports this module before forking
+MoBiLSTM_model = None
+frame_encoder, temporal_head = None, None
+encode_runner, score_runner = None, None
+
+
+# -----------------------------
+# Per-frame encoder / temporal head split
+# -----------------------------
+def split_violence_model(model):
+    """
+    Split MoBiLSTM into:
+      frame_encoder : (N, H, W, 3)            → (N, *features)
+      temporal_head : (N, SEQUENCE_LENGTH, *features) → (N, 2)
+
+    The encoder is every leading TimeDistributed layer unwrapped
+    (plus Dropout, identity at inference); the head is the rest.
+    Returns (None, None) when the model does not have that shape
+    or the split does not reproduce the full model.
+    """
+    layers = [layer for layer in model.layers if not isinstance(layer, InputLayer)]
+
+    td_positions = [i for i, layer in enumerate(layers) if isinstance(layer, TimeDistributed)]
+    if not td_positions:
+        return None, None
+
+    prefix = layers[:td_positions[-1] + 1]
+    if any(not isinstance(layer, (TimeDistributed, Dropout)) for layer in prefix):
+        return None, None
+
+    try:
+        frame_encoder = Sequential(
+            [Input(shape=(IMAGE_HEIGHT, IMAGE_WIDTH, 3))]
+            + [layer.layer if isinstance(layer, TimeDistributed) else layer for layer in prefix]
+        )
+        feature_shape = tuple(frame_encoder.output_shape[1:])
+
+        temporal_head = Sequential(
+            [Input(shape=(SEQUENCE_LENGTH,) + feature_shape)]
+            + layers[td_positions[-1] + 1:]
+        )
+    except Exception as e:
+        print("⚠️ Violence model split failed:", e)
+        return None, None
+
+    # parity check: split path must match the full model
+    rng = np.random.default_rng(0)
+    sample = rng.random((2, SEQUENCE_LENGTH, IMAGE_HEIGHT, IMAGE_WIDTH, 3), dtype=np.float32)
+
+    full_preds = np.asarray(model(sample, training=False))
+    features = np.asarray(
+        frame_encoder(sample.reshape((-1, IMAGE_HEIGHT, IMAGE_WIDTH, 3)), training=False)
+    )
+    split_preds = np.asarray(
+        temporal_head(features.reshape((2, SEQUENCE_LENGTH) + feature_shape), training=False)
+    )
+
+    max_diff = float(np.abs(full_preds - split_preds).max())
+    if max_diff > 1e-4:
+        print(f"⚠️ Violence model split mismatch (max diff {max_diff:.2e}), using full model")
+        return None, None
+
+    print(f"🧠 Violence model split: frame features {feature_shape}")
+    return frame_encoder, temporal_head
+
+
+# -----------------------------
+# Serving backends
+# -----------------------------
+# Each runner maps a float32 batch → np.ndarray for one Keras model
+# (frame_encoder, temporal_head, or the full model when unsplit).
+def keras_runner(model):
+    return lambda batch: np.asarray(model(batch, training=False))
+
+
+def function_runner(model):
+    """
+    tf.function with a fixed input signature (batch dimension left open),
+    traced once here instead of on first use.
+    """
+    spec = tf.TensorSpec((None,) + tuple(model.input_shape[1:]), tf.float32)
+    forward = tf.function(lambda batch: model(batch, training=False), input_signature=[spec])
+    forward.get_concrete_function()
+
+    return lambda batch: forward(batch).numpy()
+
+
+def export_tflite(model, path, quantization):
+    """
+    Convert one Keras model to TFLite: "fp16" (float16 weights) or "int8"
+    (dynamic-range int8 weights, float activations: no calibration set).
+    """
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+
+    if quantization == "fp16":
+        converter.target_spec.supported_types = [tf.float16]
+
+    # LSTM / Bidirectional may need TF kernels beyond the builtins
+    converter.target_spec.supported_ops = [
+        tf.lite.OpsSet.TFLITE_BUILTINS,
+        tf.lite.OpsSet.SELECT_TF_OPS
+    ]
+
+    # write beside the target and swap it in: another worker process
+    # never loads a half-written model
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(converter.convert())
+    os.replace(tmp_path, path)
+
+
+class TFLiteRunner:
+    """
+    TFLite interpreter for one exported model; the input tensor is
+    resized only when the batch size changes.
+    """
+
+    def __init__(self, path):
+        self.interpreter = tf.lite.Interpreter(
+            model_path=path,
+            num_threads=VIOLENCE_TFLITE_THREADS or None
+        )
+        self.input_index = self.interpreter.get_input_details()[0]["index"]
+        self.output_index = self.interpreter.get_output_details()[0]["index"]
+        self.shape = None
+
+    def __call__(self, batch):
+        batch = np.ascontiguousarray(batch, dtype=np.float32)
+
+        if batch.shape != self.shape:
+            self.interpreter.resize_tensor_input(self.input_index, batch.shape)
+            self.interpreter.allocate_tensors()
+            self.shape = batch.shape
+
+        self.interpreter.set_tensor(self.input_index, batch)
+        self.interpreter.invoke()
+
+        return self.interpreter.get_tensor(self.output_index).copy()
+
+
+def tflite_runner(model, part, quantization):
+    """
+    Export (when missing or older than the .keras file) and load the
+    TFLite model for one part ("encoder", "head" or "full").
+    """
+    model_dir = VIOLENCE_TFLITE_DIR or os.path.dirname(MODEL_PATH)
+    os.makedirs(model_dir, exist_ok=True)
+
+    stem = os.path.splitext(os.path.basename(MODEL_PATH))[0]
+    path = os.path.join(model_dir, f"{stem}.{part}.{quantization}.tflite")
+
+    if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(MODEL_PATH):
+        print(f"🧠 Exporting violence {part} to TFLite ({quantization}) → {path}")
+        export_tflite(model, path, quantization)
+
+    return TFLiteRunner(path)
+
+
+def build_runners(backend):
+    """
+    (encode runner or None when unsplit, score runner) for a backend name.
+    """
+    parts = (
+        [("encoder", frame_encoder), ("head", temporal_head)]
+        if frame_encoder is not None
+        else [("full", MoBiLSTM_model)]
+    )
+
+    if backend == "function":
+        runners = [function_runner(model) for _, model in parts]
+    elif backend in ("tflite-fp16", "tflite-int8"):
+        quantization = backend.split("-")[1]
+        runners = [tflite_runner(model, part, quantization) for part, model in parts]
+    else:
+        runners = [keras_runner(model) for _, model in parts]
+
+    return (None, runners[0]) if len(runners) == 1 else tuple(runners)
+
+
+def check_runner_parity(encode_runner, score_runner, tolerance=VIOLENCE_BACKEND_TOLERANCE):
+    """
+    Serving path vs the .keras model on a fixed random batch of windows.
+    """
+    rng = np.random.default_rng(1)
+    sample = rng.random((4, SEQUENCE_LENGTH, IMAGE_HEIGHT, IMAGE_WIDTH, 3), dtype=np.float32)
+
+    expected = np.asarray(MoBiLSTM_model(sample, training=False))
+
+    if encode_runner is None:
+        actual = score_runner(sample)
+    else:
+        features = encode_runner(sample.reshape((-1, IMAGE_HEIGHT, IMAGE_WIDTH, 3)))
+        actual = score_runner(features.reshape((sample.shape[0], SEQUENCE_LENGTH) + features.shape[1:]))
+
+    max_diff = float(np.abs(expected - actual).max())
+    print(f"🧠 Violence {VIOLENCE_BACKEND} parity: max diff {max_diff:.2e} (tolerance {tolerance})")
+
+    return max_diff <= tolerance
+
+
+def load_runners():
+    if VIOLENCE_BACKEND != "keras":
+        try:
+            runners = build_runners(VIOLENCE_BACKEND)
+            if check_runner_parity(*runners):
+                return runners
+            print(f"⚠️ Violence {VIOLENCE_BACKEND} backend failed parity check, using Keras")
+        except Exception as e:
+            print(f"⚠️ Violence {VIOLENCE_BACKEND} backend unavailable ({e}), using Keras")
+
+    return build_runners("keras")
+
+
+def load_violence_model():
+    """
+    Load the .keras model, split it and build the serving runners,
+    once per process.
+    """
+    global MoBiLSTM_model, frame_encoder, temporal_head, encode_runner, score_runner
+
+    if score_runner is not None:
+        return
+
+    print(f"🧠 Loading violence detection model from: {MODEL_PATH}")
+    MoBiLSTM_model = load_model(MODEL_PATH)
+    frame_encoder, temporal_head = split_violence_model(MoBiLSTM_model)
+    encode_runner, score_runner = load_runners()
+
+
+def encode_frames(frames):
+    """
+    Normalized (N, H, W, 3) frames → per-frame units for score_windows.
+    Backbone features when the model is split, the frames otherwise.
+    """
+    load_violence_model()
+    frames = np.asarray(frames, dtype="float32")
+
+    if encode_runner is None:
+        return frames
+
+    return encode_runner(frames)
+
+
+def score_windows(windows):
+    """
+    (N, SEQUENCE_LENGTH, ...) windows of encode_frames units → (N, 2)
+    class probabilities in one batched call.
+    """
+    load_violence_model()
+    return score_runner(np.asarray(windows, dtype="float32"))
 
 
 # -----------------------------
 # Video Evaluation
 # -----------------------------
-def evaluate_video_direct(
-    video_path,
-    violence_threshold=0.65,
-    display=False,
-    frame_stride=None
-):
-    cap = cv2.VideoCapture(video_path)
-    if not cap.isOpened():
-        raise ValueError(f"Cannot open video: {video_path}")
+class ViolenceVideoConsumer(FrameConsumer):
+    """
+    Slides a SEQUENCE_LENGTH window over every frame_stride-th frame.
+
+    Each sampled frame goes through the backbone once (batched); its
+    features sit in a ring buffer and finished windows are scored by
+    the temporal head in batches.
+    """
 
-    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    name = "violence"
+    decode_short_side = IMAGE_HEIGHT  # frames are resized to 64x64
 
-    if frame_stride is None:
-        frame_stride = SEQUENCE_LENGTH // 2  # safe default = 8
+    def __init__(
+        self,
+        violence_threshold=0.65,
+        frame_stride=None,
+        encode_batch_size=VIOLENCE_ENCODE_BATCH_SIZE,
+        head_batch_size=VIOLENCE_HEAD_BATCH_SIZE
+    ):
+        if frame_stride is None:
+            frame_stride = SEQUENCE_LENGTH // 2  # safe default = 8
 
-    frames_queue = deque(maxlen=SEQUENCE_LENGTH)
-    violence_sequences = 0
-    total_sequences = 0
-    frame_index = 0
+        # 1-based "frame_index % frame_stride == 0" → 0-based offset
+        super().__init__(stride=frame_stride, offset=frame_stride - 1)
 
-    while True:
-        ok, frame = cap.read()
-        if not ok:
-            break
+        self.violence_threshold = violence_threshold
+        self.frame_stride = frame_stride
+        self.encode_batch_size = encode_batch_size
+        self.head_batch_size = head_batch_size
 
-        frame_index += 1
+        self.pending_frames = []
+        self.features_queue = deque(maxlen=SEQUENCE_LENGTH)
+        self.pending_windows = []
 
-        # Skip frames based on stride
-        if frame_index % frame_stride != 0:
-            continue
+        self.violence_sequences = 0
+        self.total_sequences = 0
 
+    def feed(self, frame_idx, frame):
         resized_frame = cv2.resize(frame, (IMAGE_WIDTH, IMAGE_HEIGHT))
         normalized_frame = resized_frame.astype("float32") / 255.0
-        frames_queue.append(normalized_frame)
+        self.pending_frames.append(normalized_frame)
 
-        if len(frames_queue) == SEQUENCE_LENGTH:
-            preds = MoBiLSTM_model.predict(
-                np.expand_dims(frames_queue, axis=0),
-                verbose=0
-            )[0]
+        if len(self.pending_frames) >= self.encode_batch_size:
+            self.encode_pending()
 
-            total_sequences += 1
+    def encode_pending(self):
+        if not self.pending_frames:
+            return
 
-            if preds[1] >= violence_threshold:
-                violence_sequences += 1
+        for features in encode_frames(self.pending_frames):
+            self.features_queue.append(features)
 
-            # 🔑 advance window safely (no full reset)
-            for _ in range(frame_stride):
-                if frames_queue:
-                    frames_queue.popleft()
+            if len(self.features_queue) == SEQUENCE_LENGTH:
+                self.pending_windows.append(np.stack(self.features_queue))
 
-    cap.release()
+                # 🔑 advance window safely (no full reset)
+                for _ in range(self.frame_stride):
+                    if self.features_queue:
+                        self.features_queue.popleft()
 
-    violence_ratio = (
-        violence_sequences / total_sequences
-        if total_sequences > 0 else 0
-    )
+        self.pending_frames = []
 
-    if violence_ratio >= violence_threshold:
-        return "Violence", violence_ratio
-    else:
-        return "NonViolence", violence_ratio
+        if len(self.pending_windows) >= self.head_batch_size:
+            self.score_pending()
+
+    def score_pending(self):
+        if not self.pending_windows:
+            return
+
+        preds = score_windows(self.pending_windows)
+
+        self.total_sequences += len(preds)
+        self.violence_sequences += int((preds[:, 1] >= self.violence_threshold).sum())
+        self.pending_windows = []
+
+    def result(self):
+        # done here only means pruned by the caller after another
+        # detector rejected the video: verdict from the windows scored so far
+        if not self.done:
+            self.encode_pending()
+            self.score_pending()
+
+        violence_ratio = (
+            self.violence_sequences / self.total_sequences
+            if self.total_sequences > 0 else 0
+        )
+
+        if violence_ratio >= self.violence_threshold:
+            return "Violence", violence_ratio
+        else:
+            return "NonViolence", violence_ratio
+
+
+def evaluate_video_direct(
+    video_path,
+    violence_threshold=0.65,
+    display=False,
+    frame_stride=None
+):
+    consumer = ViolenceVideoConsumer(violence_threshold, frame_stride)
+    result = decode_shared(video_path, [consumer])["violence"]
+
+    if result is None:
+        raise ValueError(f"Violence evaluation failed: {video_path}")
+
+    return result
 
 # -----------------------------
 # Image Evaluation
 # -----------------------------
+def score_still_frame(frame):
+    """
+    Class probabilities for one normalized still frame.
+    The backbone runs once; its features are replicated SEQUENCE_LENGTH
+    times for the temporal head (same input the model saw when the
+    frame itself was replicated, at 1/SEQUENCE_LENGTH of the CNN cost).
+    """
+    features = encode_frames([frame])
+
+    # replicate same frame to match sequence model
+    window = np.repeat(features[:, np.newaxis], SEQUENCE_LENGTH, axis=1)
+
+    return score_windows(window)[0]
+
+
 def predict_image(image_path, violence_threshold=0.70):
     frame = cv2.imread(image_path)
     if frame is None:
@@ -98,11 +420,7 @@ def predict_image(image_path, violence_threshold=0.70):
     frame = cv2.resize(frame, (IMAGE_WIDTH, IMAGE_HEIGHT))
     frame = frame.astype("float32") / 255.0
 
-    # replicate same frame to match sequence model
-    frames = np.array([frame] * SEQUENCE_LENGTH)
-    frames = np.expand_dims(frames, axis=0)
-
-    preds = MoBiLSTM_model.predict(frames, verbose=0)[0]
+    preds = score_still_frame(frame)
     violence_prob = float(preds[1])
     predicted_class_name = "Violence" if violence_prob >= violence_threshold else "NonViolence"
 
@@ -144,6 +462,13 @@ def is_violence_detected(file_path, file_type=None, threshold=0.65):
     """
     label, prob = predict_violation(file_path, file_type)
 
+    return violence_verdict(label, prob, threshold)
+
+
+def violence_verdict(label, prob, threshold=0.65):
+    """
+    Final yes/no from a (label, probability) evaluation.
+    """
     return bool(label == "Violence" and prob >= threshold)
 
 
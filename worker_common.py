@@ -0,0 +1,66 @@
+import json
+
+from face_detect.minor_detect import MinorVideoConsumer
+from meetup_detect.personal_details_detect import PersonalInfoVideoConsumer
+from violance_detect.violation_detect import violence_verdict, ViolenceVideoConsumer
+from nsfw.nsfw_detector import NsfwVideoConsumer
+from frame_source import decode_shared
+
+from config import MINOR_SAMPLE_SECONDS, PII_SAMPLE_SECONDS, NSFW_SAMPLE_SECONDS, NSFW_SKIN_GATE
+
+# Shared by image_worker, video_worker and worker_pool.
+
+
+# =====================================================
+# VIDEO: DECODE ONCE, FAN OUT TO EVERY DETECTOR
+# =====================================================
+def run_shared_video_checks(file_path: str, owl):
+    """
+    One decode pass over the video feeding minor, PII, violence and NSFW
+    detectors plus the worker's own OWL consumer (`owl`, named "owl")
+    with the frames each one samples.
+    Returns {check_name: verdict}.
+    """
+    print("[VIDEO] Decoding video once for all detectors")
+
+    minor = MinorVideoConsumer(every_seconds=MINOR_SAMPLE_SECONDS)
+    personal_info = PersonalInfoVideoConsumer(every_seconds=PII_SAMPLE_SECONDS)
+    violence = ViolenceVideoConsumer()
+    # the skin gate leaves out the faces minor detection already found
+    # (frames minor did not sample fall back to detect_faces)
+    nsfw = NsfwVideoConsumer(every_seconds=NSFW_SAMPLE_SECONDS, face_boxes=minor.face_boxes)
+
+    consumers = [minor, personal_info, owl, violence, nsfw]
+
+    def prune():
+        # PII hit stops the pipeline before OWL / violence
+        if personal_info.detected:
+            owl.done = True
+            violence.done = True
+
+    results = decode_shared(file_path, consumers, prune=prune)
+
+    if NSFW_SKIN_GATE:
+        print(f"[VIDEO] Face box lookups: {minor.box_hits} cached, {minor.box_misses} detected")
+
+    if results["violence"] is not None:
+        results["violence"] = violence_verdict(*results["violence"])
+
+    return results
+
+
+# =====================================================
+# QUEUE MESSAGES
+# =====================================================
+def handle_message(message, process):
+    """
+    One raw queue message → process(payload), where process is the
+    worker's process_redis.
+    """
+    try:
+        payload = json.loads(message)
+    except json.JSONDecodeError:
+        print("⚠️ Invalid JSON")
+        return
+
+    process(payload)
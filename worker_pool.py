@@ -0,0 +1,303 @@
+"""
+Multi-process Redis consumer pool for image_worker / video_worker.
+
+The supervisor imports the worker module (loading the fork-safe models
+once: OWL-V2, NudeNet, spaCy, OpenCV dnn), then forks WORKER_PROCESSES
+consumers that share those pages copy-on-write. The TensorFlow violence
+model is loaded by each consumer after the fork. WORKER_PRELOAD=0 loads
+everything in the consumers instead.
+Each consumer claims up to WORKER_PREFETCH messages at a time into its
+own processing list (LMOVE, so claimed work survives a crash), and
+consumers that die are restarted with backoff. WORKER_POOL_ID names the
+pool's processing lists and must stay the same across restarts.
+
+Run from the repo root:
+    WORKER_POOL_ID=images-1 python worker_pool.py image [--workers 8] [--prefetch 2]
+    WORKER_POOL_ID=videos-1 python worker_pool.py video
+"""
+import argparse
+import hashlib
+import importlib
+import multiprocessing as mp
+import os
+import signal
+import time
+from collections import deque
+
+import redis
+
+from config import (
+    REDIS_HOST, REDIS_PORT, REDIS_DB, INPUT_QUEUE, REDIS_BRPOP_TIMEOUT,
+    WORKER_PROCESSES, WORKER_PREFETCH, WORKER_THREADS, WORKER_MAX_ATTEMPTS,
+    WORKER_RESTART_DELAY, WORKER_PRELOAD, WORKER_POOL_ID
+)
+
+WORKER_MODULES = {
+    "image": "image_worker",
+    "video": "video_worker"
+}
+
+MAX_RESTART_DELAY = 60.0
+STABLE_SECONDS = 60.0  # a consumer up this long resets its backoff
+
+DEAD_QUEUE = f"{INPUT_QUEUE}:dead"
+
+def processing_prefix(kind: str) -> str:
+    """
+    Processing lists of this pool: image and video pools, and pools with
+    another WORKER_POOL_ID, never touch each other's claims.
+    """
+    return f"{INPUT_QUEUE}:processing:{kind}:{WORKER_POOL_ID}:"
+
+
+def processing_key(kind: str, slot: int) -> str:
+    return f"{processing_prefix(kind)}{slot}"
+
+
+def attempts_key(kind: str, slot: int) -> str:
+    return f"{processing_key(kind, slot)}:attempts"
+
+
+def redis_client():
+    return redis.Redis(
+        host=REDIS_HOST,
+        port=REDIS_PORT,
+        db=REDIS_DB,
+        decode_responses=True
+    )
+
+
+# =====================================================
+# CONSUMER (CHILD PROCESS)
+# =====================================================
+def _limit_threads(threads: int):
+    """
+    TensorFlow thread pools are sized once, when the violence model
+    loads: runs in each consumer before it does.
+    """
+    try:
+        import tensorflow as tf
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(min(2, threads))
+    except (ImportError, RuntimeError) as e:
+        print("[POOL] TensorFlow threads not set:", e)
+
+
+def _limit_session_threads(threads: int):
+    """
+    ONNX Runtime sessions get one thread per core unless told otherwise,
+    and their pools do not survive a fork: rebuild them in this process.
+    """
+    try:
+        from nsfw.nsfw_detector import set_session_threads
+        set_session_threads(threads)
+
+        # OWL-V2 served through ONNX Runtime (OWL_BACKEND=onnx*)
+        from model import owl_model
+        if hasattr(owl_model, "set_threads"):
+            owl_model.set_threads(threads)
+    except Exception as e:
+        print("[POOL] ONNX Runtime session threads not set:", e)
+
+
+def _reset_after_fork(threads: int):
+    """
+    Per-process state that must not be inherited from the supervisor.
+    """
+    # the supervisor's handlers only set its own stop flag: without
+    # this, terminate() and Ctrl-C would leave consumers running
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+    # pooled DB connections belong to the parent: drop them, don't close
+    try:
+        from database import engine
+        engine.dispose(close=False)
+    except Exception as e:
+        print("[POOL] DB engine reset skipped:", e)
+
+    # N processes × all cores each would oversubscribe the CPU
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+
+    import cv2
+    cv2.setNumThreads(threads)
+
+
+def consume(kind: str, slot: int, prefetch: int, threads: int):
+    _reset_after_fork(threads)
+    _limit_threads(threads)
+
+    module = importlib.import_module(WORKER_MODULES[kind])
+    from worker_common import handle_message
+    from violance_detect.violation_detect import load_violence_model
+
+    _limit_session_threads(threads)
+    load_violence_model()
+
+    r = redis_client()
+
+    key = processing_key(kind, slot)
+    tries = attempts_key(kind, slot)
+
+    # messages claimed by this slot's previous process come first
+    # (LMOVE pushes left, so the oldest claim is rightmost)
+    buffer = deque(reversed(r.lrange(key, 0, -1)))
+
+    print(f"[POOL] Consumer {slot} (pid {os.getpid()}) listening on {INPUT_QUEUE}, {len(buffer)} recovered")
+
+    while True:
+        try:
+            # top up the local buffer without blocking
+            while len(buffer) < prefetch:
+                message = r.lmove(INPUT_QUEUE, key, "RIGHT", "LEFT")
+                if message is None:
+                    break
+                buffer.append(message)
+
+            if not buffer:
+                message = r.blmove(INPUT_QUEUE, key, REDIS_BRPOP_TIMEOUT, "RIGHT", "LEFT")
+                if message is None:
+                    continue
+                buffer.append(message)
+
+            message = buffer.popleft()
+            digest = hashlib.sha1(message.encode()).hexdigest()
+
+            # counted before processing: a crash mid-message leaves it
+            # incremented, so a poison message cannot loop forever
+            if r.hincrby(tries, digest, 1) > WORKER_MAX_ATTEMPTS:
+                print(f"[POOL] Consumer {slot}: giving up on message after {WORKER_MAX_ATTEMPTS} attempts")
+                r.lpush(DEAD_QUEUE, message)
+            else:
+                try:
+                    handle_message(message, module.process_redis)
+                except Exception as e:
+                    print("❌ Worker error:", e)
+
+            r.lrem(key, 1, message)
+            r.hdel(tries, digest)
+
+        except redis.RedisError as e:
+            print(f"❌ Consumer {slot} Redis error:", e)
+            time.sleep(1)
+
+
+# =====================================================
+# SUPERVISOR
+# =====================================================
+def requeue_orphans(r, kind: str, workers: int):
+    """
+    This pool's processing lists of slots beyond this run's pool size
+    (a previous run had more workers) go back to the input queue,
+    oldest first out.
+    """
+    prefix = processing_prefix(kind)
+
+    for key in r.scan_iter(match=f"{prefix}*"):
+        slot = key[len(prefix):]
+        if not slot.isdigit() or int(slot) < workers:
+            continue
+
+        moved = 0
+        # newest claim first, so the oldest ends up at the popping end
+        while r.lmove(key, INPUT_QUEUE, "LEFT", "RIGHT") is not None:
+            moved += 1
+
+        r.delete(attempts_key(kind, int(slot)))
+        print(f"[POOL] Re-queued {moved} messages from {key}")
+
+
+def supervise(kind: str, workers: int, prefetch: int, threads: int):
+    ctx = mp.get_context("fork")
+
+    # model.py leaves the PyTorch thread count to the pool
+    os.environ["WORKER_POOL_THREADS"] = str(threads)
+
+    if WORKER_PRELOAD:
+        print(f"[POOL] Loading {WORKER_MODULES[kind]} models once before forking")
+        importlib.import_module(WORKER_MODULES[kind])
+
+    requeue_orphans(redis_client(), kind, workers)
+
+    procs = {}
+    started = {}
+    delays = {slot: WORKER_RESTART_DELAY for slot in range(workers)}
+    stopping = False
+
+    def start(slot):
+        proc = ctx.Process(
+            target=consume,
+            args=(kind, slot, prefetch, threads),
+            name=f"{kind}-consumer-{slot}",
+            daemon=False
+        )
+        proc.start()
+        procs[slot] = proc
+        started[slot] = time.monotonic()
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    print(f"🚀 Worker pool: {workers} × {kind} consumers, prefetch {prefetch}, {threads} threads each")
+    for slot in range(workers):
+        start(slot)
+
+    restart_at = {}
+
+    while not stopping:
+        time.sleep(0.5)
+        now = time.monotonic()
+
+        for slot, proc in list(procs.items()):
+            if proc.is_alive():
+                if now - started[slot] > STABLE_SECONDS:
+                    delays[slot] = WORKER_RESTART_DELAY
+                continue
+
+            if slot not in restart_at:
+                print(f"⚠️ Consumer {slot} exited (code {proc.exitcode}), restarting in {delays[slot]:.0f}s")
+                restart_at[slot] = now + delays[slot]
+                delays[slot] = min(MAX_RESTART_DELAY, delays[slot] * 2)
+            elif now >= restart_at[slot]:
+                del restart_at[slot]
+                proc.close()
+                start(slot)
+
+    print("[POOL] Stopping consumers")
+    for proc in procs.values():
+        if proc.is_alive():
+            proc.terminate()
+    for proc in procs.values():
+        proc.join(timeout=30)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("kind", choices=sorted(WORKER_MODULES))
+    parser.add_argument("--workers", type=int, default=WORKER_PROCESSES)
+    parser.add_argument("--prefetch", type=int, default=WORKER_PREFETCH)
+    parser.add_argument("--threads", type=int, default=WORKER_THREADS)
+    args = parser.parse_args()
+
+    # a restarted pool must find its own processing lists again, or the
+    # messages its previous run claimed are never re-queued
+    if not WORKER_POOL_ID:
+        parser.error("WORKER_POOL_ID must be set to a stable id (one per pool, kept across restarts)")
+
+    cpus = os.cpu_count() or 1
+    workers = args.workers or max(1, cpus // 4)
+    threads = args.threads or max(1, cpus // workers)
+
+    supervise(args.kind, workers, max(1, args.prefetch), threads)
+
+
+if __name__ == "__main__":
+    main()